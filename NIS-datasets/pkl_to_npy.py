@@ -0,0 +1,20 @@
+# Convert pdp_*.pkl datasets to the memory-mapped .npy files of PDPMemmapDataset.
+# Run from the repository root: python NIS-datasets/pkl_to_npy.py NIS-datasets/pdp_100.pkl
+import os
+import sys
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from problems.problem_pdp import PDPMemmapDataset
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        'filenames', nargs='+', help='.pkl files, each .npy is written next to it'
+    )
+    args = parser.parse_args()
+
+    for filename in args.filenames:
+        print(f'{filename} -> {PDPMemmapDataset.from_pkl(filename)}')
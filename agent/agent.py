@@ -47,7 +47,7 @@ class Agent(ABC):
         batch: Dict[str, torch.Tensor],
         show_bar: bool,
         zoom: bool,
-    ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
+    ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
         pass
 
     @abstractmethod
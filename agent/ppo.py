@@ -1,4 +1,4 @@
-from typing import Any, Dict, List, Optional, Tuple
+from typing import Dict, Optional, Sequence, Tuple
 import os
 from tqdm import tqdm
 import warnings
@@ -9,35 +9,112 @@ import torch.distributed as dist
 from tensorboard_logger import Logger as TbLogger
 import math
 import random
+import time
+import itertools
 
 from utils import clip_grad_norms
 from nets.actor_network import Actor_NNS, Actor_Construct
 from nets.critic_network import Critic_NNS, Critic_Construct
 from utils import torch_load_cpu, get_inner_model, move_to, batch_picker
 from utils.logger import log_to_tb_train
-from problems.problem_pdp import PDP
+from problems.problem_pdp import (
+    PDP,
+    SolutionState,
+    ActionRemovalRecord,
+    SliceSampler,
+)
 from options import Option
 
 from .agent import Agent
-from .utils import validate, batch_augments, mem_test, zoom_feature
+from .utils import (
+    validate,
+    batch_augments,
+    scale_feature,
+    get_best_copy_rows,
+    get_view_rows,
+    get_distance_rows,
+    mem_test,
+    zoom_feature,
+    is_cost_resync_step,
+    reduce_best_solution,
+    get_history_steps,
+    get_time_fractions,
+)
 
 
 class Memory:
-    def __init__(self) -> None:
-        self.actions: List[torch.Tensor] = []
-        self.states: List[torch.Tensor] = []
-        self.logprobs: List[torch.Tensor] = []
-        self.rewards: List[torch.Tensor] = []
-        self.best_obj: List[torch.Tensor] = []
-        self.action_removal_record: List[List[torch.Tensor]] = []
-
-    def clear_memory(self) -> None:
-        del self.actions[:]
-        del self.states[:]
-        del self.logprobs[:]
-        del self.rewards[:]
-        del self.best_obj[:]
-        del self.action_removal_record[:]
+    def __init__(
+        self,
+        n_step: int,
+        batch_size: int,
+        graph_size: int,
+        record_length: int,
+        device: torch.device,
+    ) -> None:
+        # preallocated for n_step steps, written in place and read back as views
+        index_dtype = torch.int16 if graph_size < 2**15 else torch.int32
+        shp_index = (n_step, batch_size, graph_size + 1)
+
+        self.size = 0
+        self.record_length = record_length
+        self.actions = torch.zeros(
+            (n_step + 1, batch_size, 3), dtype=index_dtype, device=device
+        )  # with the action before the first step
+        self.posts = torch.zeros(shp_index, dtype=index_dtype, device=device)
+        self.visit_index = torch.zeros(shp_index, dtype=index_dtype, device=device)
+        self.removal_last3 = torch.zeros(
+            (n_step, batch_size, 3), dtype=index_dtype, device=device
+        )
+        self.removal_counts = torch.zeros(
+            (n_step, batch_size, graph_size // 2), dtype=index_dtype, device=device
+        )
+        self.logprobs = torch.zeros((n_step, batch_size), device=device)  # detached
+        self.rewards = torch.zeros((n_step, batch_size), device=device)
+        self.best_obj = torch.zeros((n_step, batch_size, 1), device=device)
+
+    def reset(self, action: torch.Tensor) -> None:
+        self.size = 0
+        self.actions[0] = action
+
+    def push(
+        self,
+        state: SolutionState,  # with visit_index, as after an actor pass
+        action_removal_record: ActionRemovalRecord,
+        action: torch.Tensor,
+        logprobs: torch.Tensor,
+        best_obj: torch.Tensor,
+    ) -> None:
+        t = self.size
+        self.posts[t] = state.post
+        self.visit_index[t] = state.visit_index
+        self.removal_last3[t] = action_removal_record.last3()
+        self.removal_counts[t] = action_removal_record.counts
+        self.actions[t + 1] = action
+        self.logprobs[t] = logprobs.detach()
+        self.best_obj[t] = best_obj
+        self.size += 1
+
+    def push_rewards(self, rewards: torch.Tensor) -> None:
+        self.rewards[self.size - 1] = rewards
+
+    def get_states(self, start: int, end: int) -> SolutionState:
+        # steps [start, end) stacked along the batch
+        post = self.posts[start:end].flatten(0, 1).long()
+        pre = torch.empty_like(post).scatter_(
+            1, post, torch.arange(post.size(1), device=post.device).expand_as(post)
+        )
+        visit_index = self.visit_index[start:end].flatten(0, 1).long()
+        return SolutionState(post, pre, visit_index)
+
+    def get_action_removal_recent(self, start: int, end: int) -> torch.Tensor:
+        return ActionRemovalRecord.get_recent(
+            self.removal_last3[start:end].flatten(0, 1),
+            self.removal_counts[start:end].flatten(0, 1),
+            self.record_length,
+        )  # ((end-start)*batch_size, 4, graph_size/2)
+
+    def get_actions(self) -> torch.Tensor:
+        return self.actions[: self.size + 1].long()  # (size+1, batch_size, 3)
 
 
 class PPO(Agent):
@@ -57,6 +134,8 @@ class PPO(Agent):
             seq_length=size + 1,
             embedding_type=opts.embed_type_nns,
             removal_type=opts.removal_type,
+            reinsertion_chunk_size=opts.reinsertion_chunk_size,
+            sparse_reinsertion=opts.sparse_reinsertion,
         )
 
         if opts.shared_critic:
@@ -218,33 +297,37 @@ class PPO(Agent):
         batch: Dict[str, torch.Tensor],
         show_bar: bool,
         zoom: bool = False,
-    ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
+    ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
+        s_time = time.time()
         batch = move_to(batch, self.opts.device)
         batch_size, graph_size_plus1, node_dim = batch['coordinates'].size()
 
-        batch_augments(val_m, batch, graph_size_plus1, node_dim)
+        view_of_copy = batch_augments(
+            val_m,
+            batch,
+            graph_size_plus1,
+            node_dim,
+            plan=self.opts.val_m_augments,
+            rotations=self.opts.val_m_rotations,
+        )
 
         batch_feature = PDP.input_coordinates(
             batch
         )  # (new_batch_size, graph_size+1, node_dim)
-        new_batch_size = batch_feature.size(0)
 
         if not self.opts.shared_critic:
             solution = move_to(
                 problem.get_initial_solutions(batch), self.opts.device
             ).long()
 
-            obj = problem.get_costs(batch_feature, solution, zoom)  # (new_batch_size,)
+            obj = problem.get_costs(
+                batch_feature,
+                solution,
+                zoom,
+                batch.get('distances'),
+                batch.get('distance_rows'),
+            )  # (new_batch_size,)
         else:
-            solution_list = []
-            obj_list = []
-
-            if self.opts.inference_sample_size >= self.opts.inference_sample_batch:
-                ms_batch_feature = batch_feature.unsqueeze(1).repeat(
-                    1, self.opts.inference_sample_batch, 1, 1
-                )
-                ms_batch_feature = ms_batch_feature.view(-1, graph_size_plus1, node_dim)
-
             pbar = tqdm(
                 total=math.ceil(
                     self.opts.inference_sample_size / self.opts.inference_sample_batch
@@ -255,110 +338,272 @@ class PPO(Agent):
                 bar_format='{l_bar}{bar:20}{r_bar}{bar:-20b}',
             )
 
-            for sample_batch in batch_picker(
-                self.opts.inference_sample_size, self.opts.inference_sample_batch
-            ):
-                if sample_batch < self.opts.inference_sample_batch:
-                    ms_batch_feature = batch_feature.unsqueeze(1).repeat(
-                        1, sample_batch, 1, 1
+            # copies drawing the same view are encoded and constructed once
+            view_rows, view_index = get_view_rows(view_of_copy, batch_size)
+            view_rows = view_rows.to(batch_feature.device)
+            view_index = view_index.to(batch_feature.device)
+            view_batch = {
+                k: v if k == 'distances' else v[view_rows]  # tables by instance
+                for k, v in batch.items()
+                if k in ('distances', 'distance_rows', 'input_scale')
+            }
+            view_feature = batch_feature[view_rows]
+
+            if self.opts.shared_encoding_sample:
+                # copies of one view share its encoding, each still samples its own
+                obj, solution = sample_initial_solutions(
+                    problem,
+                    self.actor_construct,
+                    view_feature,
+                    self.opts.inference_sample_size,
+                    self.opts.inference_sample_batch,
+                    self.opts.inference_temperature,
+                    zoom,
+                    pbar,
+                    view_index=view_index,
+                    input_scale=view_batch.get('input_scale'),
+                    distances=batch.get('distances'),
+                    distance_rows=batch.get('distance_rows'),
+                )
+            else:
+                best: Optional[Tuple[torch.Tensor, torch.Tensor]] = None
+                n_view_rows = view_feature.size(0)
+
+                if self.opts.inference_sample_size >= self.opts.inference_sample_batch:
+                    ms_batch_feature = view_feature.unsqueeze(1).repeat(
+                        1, self.opts.inference_sample_batch, 1, 1
                     )
                     ms_batch_feature = ms_batch_feature.view(
                         -1, graph_size_plus1, node_dim
                     )
 
-                for temperature in self.opts.inference_temperature:
-                    if zoom:
-                        ms_batch_feature_4actor, _ = zoom_feature(ms_batch_feature)
-                    else:
-                        ms_batch_feature_4actor = ms_batch_feature
-                    solution, _ = self.actor_construct(
-                        ms_batch_feature_4actor, temperature=temperature
-                    )
-                    obj = problem.get_costs(ms_batch_feature, solution, zoom)
-
-                    solution = solution.view(new_batch_size, sample_batch, -1)
-                    obj = obj.view(new_batch_size, sample_batch)
-
-                    solution_list.append(solution)
-                    obj_list.append(obj)
+                for sample_batch in batch_picker(
+                    self.opts.inference_sample_size, self.opts.inference_sample_batch
+                ):
+                    if sample_batch < self.opts.inference_sample_batch:
+                        ms_batch_feature = view_feature.unsqueeze(1).repeat(
+                            1, sample_batch, 1, 1
+                        )
+                        ms_batch_feature = ms_batch_feature.view(
+                            -1, graph_size_plus1, node_dim
+                        )
 
-                    pbar.update(1)
-            # pbar.close()
-
-            solution = torch.cat(solution_list, 1)
-            obj = torch.cat(obj_list, 1)
-
-            min_sol_index = obj.argmin(dim=1)
-            obj = obj[torch.arange(new_batch_size), min_sol_index]
-            solution = solution[torch.arange(new_batch_size), min_sol_index]
-
-            if val_m > 1 and False:  # shut down
-                obj_aug = obj.reshape(batch_size, val_m)
-                solution_aug = solution.reshape(batch_size, val_m, -1)
-
-                min_sol_index_among_val_m = obj_aug.argmin(dim=1)
-                obj_val_m = obj_aug[torch.arange(batch_size), min_sol_index_among_val_m]
-                solution_val_m = solution_aug[
-                    torch.arange(batch_size), min_sol_index_among_val_m
-                ]
-
-                obj = obj_val_m.unsqueeze(1).repeat(1, val_m).reshape(-1)
-                solution = (
-                    solution_val_m.unsqueeze(1)
-                    .repeat(1, val_m, 1)
-                    .reshape(new_batch_size, -1)
-                )
+                    for temperature in self.opts.inference_temperature:
+                        if zoom:
+                            ms_batch_feature_4actor = zoom_feature(ms_batch_feature)[0]
+                        elif 'input_scale' in view_batch:
+                            ms_batch_feature_4actor = scale_feature(
+                                ms_batch_feature,
+                                view_batch['input_scale'].repeat_interleave(
+                                    sample_batch
+                                ),
+                            )
+                        else:
+                            ms_batch_feature_4actor = ms_batch_feature
+                        solution, _ = self.actor_construct(
+                            ms_batch_feature_4actor, temperature=temperature
+                        )
+                        obj = problem.get_costs(
+                            ms_batch_feature,
+                            solution,
+                            zoom,
+                            view_batch.get('distances'),
+                            get_distance_rows(view_batch, sample_batch),
+                        )
 
-        obj_history = [
-            torch.cat((obj[:, None], obj[:, None]), -1)
-        ]  # [(new_batch_size, 2)]
+                        best = reduce_best_solution(
+                            best,
+                            obj.view(n_view_rows, sample_batch),
+                            solution.view(n_view_rows, sample_batch, -1),
+                        )
 
-        rewards: List[torch.Tensor] = []
+                        pbar.update(1)
+                # pbar.close()
+
+                # the copies of a view start from its best sample and only differ in
+                # the RNG stream of their search
+                assert best is not None
+                obj, solution = best[0][view_index], best[1][view_index]
+
+        # the augments cooperate, every copy goes on from the best solution so far
+        share_steps = self.opts.val_m_share_steps if val_m > 1 else 0
+        if share_steps > 0:
+            rows = get_best_copy_rows(obj, val_m)
+            obj, solution = obj[rows], solution[rows]
+
+        state = SolutionState(solution)
+        best_sol = solution.clone() if share_steps > 0 else None
+
+        # only the kept steps of the histories, reduced over the val_m augments
+        # with a time budget, the kept points are fractions of it instead
+        time_budget = self.opts.time_budget
+        if time_budget > 0:
+            if self.opts.time_budget_amortized:  # seconds per instance on average
+                time_budget *= batch_size
+            time_points = [
+                time_budget * fraction
+                for fraction in get_time_fractions(self.opts.time_points)
+            ]
+            history_steps = []
+            n_filled = 1  # time points recorded so far
+        else:
+            history_steps = get_history_steps(
+                self.opts.history_mode, self.opts.T_max, self.opts.history_steps
+            )
+        history_column = {step: i for i, step in enumerate(history_steps)}
+        obj_history = torch.empty(
+            (batch_size, len(time_points if time_budget > 0 else history_steps), 2),
+            device=obj.device,
+        )  # current and best obj
+        obj_history[:, 0] = obj.view(batch_size, val_m).min(1)[0].unsqueeze(-1)
+        reward_stats = torch.zeros(
+            (batch_size, 2), device=obj.device
+        )  # sum and sum of squares of the step rewards
+        final_obj = obj_history[:, 0].clone()  # (batch_size, 2)
+
+        # instances still searched, the others stagnated and left the batch
+        stagnation_steps = self.opts.stagnation_steps
+        active = torch.arange(batch_size, device=obj.device)
+        steps_used = torch.full(
+            (batch_size,), self.opts.T_max, dtype=torch.long, device=obj.device
+        )
+        last_best = final_obj[:, 1].clone()
+        n_stagnant = torch.zeros(batch_size, dtype=torch.long, device=obj.device)
+        n_done = 0  # steps done by the instances still searched
 
         action = None
-        action_removal_record = [
-            torch.zeros((batch_feature.size(0), problem.size // 2))
-            for _ in range(problem.size // 2)  # NNS paper section 4.4 last sentence
-        ]
+        action_removal_record = ActionRemovalRecord(
+            batch_feature.size(0),
+            problem.size // 2,
+            problem.size // 2,  # NNS paper section 4.4 last sentence
+            batch_feature.device,
+        )
 
-        for _ in tqdm(
-            range(self.opts.T_max),
+        for t in tqdm(
+            range(self.opts.T_max) if time_budget <= 0 else itertools.count(),
             disable=self.opts.no_progress_bar or not show_bar,
             desc='rollout',
             bar_format='{l_bar}{bar:20}{r_bar}{bar:-20b}',
         ):
+            if time_budget > 0 and time.time() - s_time >= time_budget:
+                break
+
             # pass through model
             if zoom:
                 batch_feature_4actor, _ = zoom_feature(batch_feature)
+            elif 'input_scale' in batch:
+                batch_feature_4actor = scale_feature(
+                    batch_feature, batch['input_scale']
+                )
             else:
                 batch_feature_4actor = batch_feature
             action = self.actor(
-                problem, batch_feature_4actor, solution, action, action_removal_record
+                problem,
+                batch_feature_4actor,
+                state,
+                action,
+                action_removal_record,
+                distances=batch.get('distances'),
+                distance_rows=batch.get('distance_rows'),
             )[0]
 
             # new solution
-            solution, reward, obj, action_removal_record = problem.step(
-                batch, solution, action, obj, action_removal_record, zoom=zoom
+            state, reward, obj, action_removal_record = problem.step(
+                batch,
+                state,
+                action,
+                obj,
+                action_removal_record,
+                best_sol=best_sol,
+                zoom=zoom,
+                full_cost=is_cost_resync_step(t, self.opts.cost_resync_steps),
             )
 
+            n_done = t + 1
+
+            if share_steps > 0 and (t + 1) % share_steps == 0:
+                assert best_sol is not None
+                rows = get_best_copy_rows(obj[:, 1], val_m)
+                best_sol = best_sol[rows]
+                post = best_sol.clone()
+                pre = torch.empty_like(post).scatter_(
+                    1,
+                    post,
+                    torch.arange(post.size(1), device=post.device).expand_as(post),
+                )
+                state = SolutionState(post, pre)  # the actor derives visit_index
+                obj = obj[rows, 1:].repeat(1, 2)
+
+            if time_budget > 0:
+                # the points passed during this step get the costs from before it
+                if obj.is_cuda:
+                    torch.cuda.synchronize(obj.device)
+                elapsed = time.time() - s_time
+                while n_filled < len(time_points) and time_points[n_filled] <= elapsed:
+                    obj_history[:, n_filled] = final_obj
+                    n_filled += 1
+
             # record informations
-            rewards.append(reward)  # [(new_batch_size,), ...]
-            obj_history.append(obj)  # [(new_batch_size, 2), ...]
+            n_active = active.size(0)
+            reward = reward.view(n_active, val_m).max(1)[0]
+            reward_stats.index_add_(
+                0, active, torch.stack((reward, reward * reward), -1)
+            )
+            final_obj[active] = obj.view(n_active, val_m, 2).min(1)[0]
+            if t + 1 in history_column:
+                obj_history[active, history_column[t + 1]] = final_obj[active]
+
+            if stagnation_steps > 0:
+                best = final_obj[active, 1]
+                n_stagnant = torch.where(best < last_best, 0, n_stagnant + 1)
+                last_best = best
+                is_done = n_stagnant >= stagnation_steps
+                if is_done.any():
+                    steps_used[active[is_done]] = t + 1
+                    keep = (~is_done).nonzero().view(-1)
+                    active, n_stagnant, last_best = (
+                        active[keep],
+                        n_stagnant[keep],
+                        last_best[keep],
+                    )
+                    if keep.numel() == 0:
+                        break
+                    rows = (
+                        keep.view(-1, 1) * val_m
+                        + torch.arange(val_m, device=keep.device)
+                    ).view(-1)
+                    batch = {
+                        k: v if k == 'distances' else v[rows]  # tables by instance
+                        for k, v in batch.items()
+                    }
+                    batch_feature = batch_feature[rows]
+                    state = state.select(rows)
+                    if best_sol is not None:
+                        best_sol = best_sol[rows]
+                    obj = obj[rows]
+                    action = action[rows]
+                    action_removal_record.select_(rows)
 
         if self.opts.shared_critic:
             pbar.close()
 
+        steps_used[active] = n_done
+
+        if time_budget > 0:  # the points not reached hold the final obj
+            obj_history[:, n_filled:] = final_obj.unsqueeze(1)
+        elif stagnation_steps > 0:  # the kept steps after stopping hold the final obj
+            is_stopped = (
+                torch.tensor(history_steps, device=obj.device).view(1, -1)
+                > steps_used.view(-1, 1)
+            ).unsqueeze(-1)
+            obj_history = torch.where(is_stopped, final_obj.unsqueeze(1), obj_history)
+
         out = (
-            obj[:, -1].reshape(batch_size, val_m).min(1)[0],  # (batch_size, 1)
-            torch.stack(obj_history, 1)[:, :, 0]  # current obj history
-            .view(batch_size, val_m, -1)
-            .min(1)[0],  # (batch_size, T_max)
-            torch.stack(obj_history, 1)[:, :, -1]  # current best obj history
-            .view(batch_size, val_m, -1)
-            .min(1)[0],  # (batch_size, T_max)
-            torch.stack(rewards, 1)
-            .view(batch_size, val_m, -1)
-            .max(1)[0],  # (batch_size, T_max)
+            final_obj[:, -1].contiguous(),  # (batch_size,)
+            obj_history[:, :, 0],  # current obj history, (batch_size, n_kept)
+            obj_history[:, :, -1],  # current best obj history, (batch_size, n_kept)
+            reward_stats,  # (batch_size, 2)
+            steps_used,  # (batch_size,)
         )
 
         return out
@@ -506,15 +751,9 @@ def train(
                 size=opts.graph_size,
                 num_samples=opts.batch_size // opts.world_size,
                 silence=True,
+                distance_dtype=opts.distance_dtype,
             )
-            training_dataloader_test = DataLoader(
-                training_dataset_test,
-                batch_size=opts.batch_size // opts.world_size,
-                shuffle=False,
-                num_workers=0,
-                pin_memory=True,
-            )
-            mem_test(agent, problem, next(iter(training_dataloader_test)))
+            mem_test(agent, problem, training_dataset_test[:])
     if opts.distributed:
         dist.barrier()
 
@@ -544,30 +783,32 @@ def train(
                 ),
                 flush=True,
             )
-        # prepare training data
+        # prepare training data, generated on device from a seed of its own per
+        # epoch, so that every rank has the same epoch and a resumed run too
+        device = torch.device("cuda", rank) if opts.distributed else opts.device
         training_dataset = PDP.make_dataset(
-            size=opts.graph_size, num_samples=opts.epoch_size
+            size=opts.graph_size,
+            num_samples=opts.epoch_size,
+            distance_dtype=opts.distance_dtype,
+            device=device,
+            generator=torch.Generator(device).manual_seed(opts.seed + epoch),
         )
         if opts.distributed:
-            train_sampler: Any = torch.utils.data.distributed.DistributedSampler(
-                training_dataset, shuffle=False
-            )
-            training_dataloader = DataLoader(
-                training_dataset,
-                batch_size=opts.batch_size // opts.world_size,
-                shuffle=False,
-                num_workers=0,
-                pin_memory=True,
-                sampler=train_sampler,
+            train_sampler = SliceSampler(
+                len(training_dataset),
+                opts.batch_size // opts.world_size,
+                opts.world_size,
+                rank,
             )
         else:
-            training_dataloader = DataLoader(
-                training_dataset,
-                batch_size=opts.batch_size,
-                shuffle=False,
-                num_workers=0,
-                pin_memory=True,
-            )
+            train_sampler = SliceSampler(len(training_dataset), opts.batch_size)
+        training_dataloader = DataLoader(
+            training_dataset,
+            batch_size=None,  # every batch is one slice of the dataset
+            sampler=train_sampler,
+            num_workers=0,
+            pin_memory=device.type == 'cpu',  # already on device otherwise
+        )
 
         if opts.distributed:
             dist.barrier()
@@ -633,6 +874,70 @@ def train(
             dist.barrier()
 
 
+def sample_initial_solutions(
+    problem: PDP,
+    actor_construct: torch.nn.Module,
+    batch_feature: torch.Tensor,
+    sample_size: int,
+    sample_batch_size: int,
+    temperatures: Sequence[float] = (1,),
+    zoom: bool = False,
+    pbar: Optional[tqdm] = None,
+    view_index: Optional[torch.Tensor] = None,
+    input_scale: Optional[torch.Tensor] = None,  # of the rows of batch_feature
+    distances: Optional[torch.Tensor] = None,
+    distance_rows: Optional[torch.Tensor] = None,  # table of each sampled row
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    # encode every instance once, then decode sample_batch_size solutions of each
+    # instance per pass against the shared encoding
+    # with view_index, batch_feature holds distinct views only and the solutions are
+    # sampled for the rows batch_feature[view_index], each view encoded once
+    model = get_inner_model(actor_construct)
+    best: Optional[Tuple[torch.Tensor, torch.Tensor]] = None
+
+    with torch.no_grad():
+        if zoom:
+            feature_4actor = zoom_feature(batch_feature)[0]
+        elif input_scale is not None:
+            feature_4actor = scale_feature(batch_feature, input_scale)
+        else:
+            feature_4actor = batch_feature
+        hN, hN_mean = model.encode(feature_4actor)
+        if view_index is not None:
+            batch_feature = batch_feature[view_index]
+            hN, hN_mean = hN[view_index], hN_mean[view_index]
+
+        for sample_batch in batch_picker(sample_size, sample_batch_size):
+            ms_batch_feature = batch_feature.repeat_interleave(sample_batch, 0)
+            ms_distance_rows = (
+                get_distance_rows(
+                    {'distances': distances, 'distance_rows': distance_rows},
+                    sample_batch,
+                )
+                if distances is not None
+                else None
+            )
+            for temperature in temperatures:
+                solution, _ = model.decode(
+                    hN, hN_mean, sample_batch, temperature=temperature
+                )  # (batch_size*sample_batch, graph_size+1)
+                obj = problem.get_costs(
+                    ms_batch_feature, solution, zoom, distances, ms_distance_rows
+                )
+
+                best = reduce_best_solution(
+                    best,
+                    obj.view(hN.size(0), sample_batch),
+                    solution.view(hN.size(0), sample_batch, -1),
+                )
+
+                if pbar is not None:
+                    pbar.update(1)
+
+    assert best is not None
+    return best  # (batch_size,), (batch_size, graph_size+1)
+
+
 def train_batch(
     rank: int,
     problem: PDP,
@@ -647,7 +952,6 @@ def train_batch(
 ) -> None:
     # setup
     agent.train()
-    memory = Memory()
 
     # prepare the input
     batch = (
@@ -665,10 +969,12 @@ def train_batch(
         else move_to(torch.tensor([-1, -1, -1]).repeat(batch_size, 1), opts.device)
     )
 
-    action_removal_record = [
-        torch.zeros((batch_feature.size(0), problem.size // 2))
-        for _ in range(problem.size)  # NNS paper section 4.4 last sentence
-    ]
+    action_removal_record = ActionRemovalRecord(
+        batch_feature.size(0),
+        problem.size // 2,
+        problem.size,  # NNS paper section 4.4 last sentence
+        batch_feature.device,
+    )
 
     # initial solution
     if not opts.shared_critic or opts.no_sample_init:
@@ -677,7 +983,9 @@ def train_batch(
             if opts.distributed
             else move_to(problem.get_initial_solutions(batch), opts.device)
         )
-        obj = problem.get_costs(batch_feature, solution)
+        obj = problem.get_costs(
+            batch_feature, solution, distances=batch.get('distances')
+        )
         best_sol = solution.clone()
     else:
         agent.eval()
@@ -686,10 +994,20 @@ def train_batch(
             solution, _ = agent.actor_construct(
                 batch_feature, temperature=opts.cur_temperature
             )
-            obj = problem.get_costs(batch_feature, solution)
+            obj = problem.get_costs(
+                batch_feature, solution, distances=batch.get('distances')
+            )
+        elif opts.shared_encoding_sample:
+            obj, solution = sample_initial_solutions(
+                problem,
+                agent.actor_construct,
+                batch_feature,
+                opts.cur_init_sample_size,
+                opts.max_init_sample_batch,
+                distances=batch.get('distances'),
+            )
         else:
-            solution_list = []
-            obj_list = []
+            best: Optional[Tuple[torch.Tensor, torch.Tensor]] = None
 
             if opts.cur_init_sample_size >= opts.max_init_sample_batch:
                 ms_batch_feature = batch_feature.unsqueeze(1).repeat(
@@ -709,30 +1027,33 @@ def train_batch(
                     )
 
                 solution, _ = agent.actor_construct(ms_batch_feature)
-                obj = problem.get_costs(ms_batch_feature, solution)
-
-                solution = solution.view(batch_size, sample_batch, -1)
-                obj = obj.view(batch_size, sample_batch)
-
-                solution_list.append(solution)
-                obj_list.append(obj)
+                obj = problem.get_costs(
+                    ms_batch_feature,
+                    solution,
+                    distances=batch.get('distances'),
+                    distance_rows=get_distance_rows(batch, sample_batch),
+                )
 
-            solution = torch.cat(solution_list, 1)
-            obj = torch.cat(obj_list, 1)
+                best = reduce_best_solution(
+                    best,
+                    obj.view(batch_size, sample_batch),
+                    solution.view(batch_size, sample_batch, -1),
+                )
 
-            min_sol_index = obj.argmin(dim=1)
-            obj = obj[torch.arange(batch_size), min_sol_index]
-            solution = solution[torch.arange(batch_size), min_sol_index]
+            assert best is not None
+            obj, solution = best
 
         best_sol = solution.clone()
 
         agent.train()
 
+    state = SolutionState(solution)
+
     # warm_up
     if opts.warm_up > 0:
         agent.eval()
 
-        for _ in range(
+        for t_warm_up in range(
             min(
                 opts.max_warm_up,
                 int(max(0, (epoch - opts.start_warm_up_epoch) // opts.warm_up)),
@@ -740,19 +1061,27 @@ def train_batch(
         ):
             # get model output
             action = agent.actor(
-                problem, batch_feature, solution, action, action_removal_record
+                problem, batch_feature, state, action, action_removal_record
             )[0]
 
             # state transient
-            solution, rewards, obj, action_removal_record = problem.step(
-                batch, solution, action, obj, action_removal_record, best_sol
+            state, rewards, obj, action_removal_record = problem.step(
+                batch,
+                state,
+                action,
+                obj,
+                action_removal_record,
+                best_sol,
+                full_cost=is_cost_resync_step(t_warm_up, opts.cost_resync_steps),
             )
 
         if opts.warm_up_type == 'update':
             obj = obj.view(batch_size, -1)[:, -1]
-            solution = best_sol
+            state = SolutionState(best_sol)
         else:
-            obj = problem.get_costs(batch_feature, solution)
+            obj = problem.get_costs(
+                batch_feature, state.post, distances=batch.get('distances')
+            )
 
         agent.train()
 
@@ -764,9 +1093,16 @@ def train_batch(
     eps_clip = opts.eps_clip
     t = 0
     initial_cost = obj
-    best_sol = solution.clone()
+    best_sol = state.post.clone()
     imitation_loss = None
     grad_norms_imi = None
+    memory = Memory(
+        n_step,
+        batch_size,
+        problem.size,
+        action_removal_record.length,
+        batch_feature.device,
+    )
 
     if opts.sc_map_sample_type == 'augment':
         batch_for_sample = {'coordinates': batch_feature.clone()}
@@ -779,7 +1115,8 @@ def train_batch(
     # sample trajectory
     while t < T:  # t will add n_step next time
         t_s = t
-        memory.actions.append(action)
+        memory.reset(action)
+        logprobs_with_grad = []
 
         # data array
         total_cost = torch.tensor(0)
@@ -799,30 +1136,34 @@ def train_batch(
                 construct_solution, construct_logprobs = agent.actor_construct(
                     batch_feature
                 )
-            construct_obj = problem.get_costs(batch_feature, construct_solution)
+            construct_obj = problem.get_costs(
+                batch_feature, construct_solution, distances=batch.get('distances')
+            )
             old_construct_logprobs = construct_logprobs
 
             obj_of_nns = []
 
         while t - t_s < n_step and not (t == T):
-            memory.states.append(solution)
-            memory.action_removal_record.append(action_removal_record)
-
             # get model output
 
             action, log_lh, to_critic_, entro_p = agent.actor(
                 problem,
                 batch_feature,
-                solution,
+                state,
                 action,
                 action_removal_record,
                 require_entropy=True,
                 to_critic=True,
             )
 
-            memory.actions.append(action)
-            memory.logprobs.append(log_lh)
-            memory.best_obj.append(obj.view(obj.size(0), -1)[:, -1].unsqueeze(-1))
+            memory.push(
+                state,
+                action_removal_record,
+                action,
+                log_lh,
+                obj.view(obj.size(0), -1)[:, -1].unsqueeze(-1),
+            )
+            logprobs_with_grad.append(log_lh)
 
             if opts.shared_critic:
                 obj_of_nns.append(obj.view(obj.size(0), -1)[:, 0])
@@ -837,10 +1178,16 @@ def train_batch(
             bl_val_list.append(baseline_val)
 
             # state transient
-            solution, rewards, obj, action_removal_record = problem.step(
-                batch, solution, action, obj, action_removal_record, best_sol
+            state, rewards, obj, action_removal_record = problem.step(
+                batch,
+                state,
+                action,
+                obj,
+                action_removal_record,
+                best_sol,
+                full_cost=is_cost_resync_step(t, opts.cost_resync_steps),
             )
-            memory.rewards.append(rewards)
+            memory.push_rewards(rewards)
             # memory.mask_true = memory.mask_true + info['swaped']
 
             # store info
@@ -855,15 +1202,14 @@ def train_batch(
 
         # begin update        =======================
 
-        # convert list to tensor
-        all_actions = torch.stack(memory.actions)
-        old_states = torch.stack(memory.states).detach().view(t_time, batch_size, -1)
+        # views of the memory
+        all_actions = memory.get_actions()
         old_actions = all_actions[1:].view(t_time, -1, 3)
-        old_logprobs = torch.stack(memory.logprobs).detach().view(-1)
+        old_logprobs = memory.logprobs[:t_time].view(-1)
         old_pre_actions = all_actions[:-1].view(t_time, -1, 3)
-        old_action_removal_record = memory.action_removal_record
 
-        old_best_obj = torch.stack(memory.best_obj)
+        old_best_obj = memory.best_obj[:t_time]
+        old_rewards = memory.rewards[:t_time]
 
         # Optimize ppo policy for K mini-epochs:
         old_value = None
@@ -872,7 +1218,7 @@ def train_batch(
 
         for k_ in range(K_epochs):
             if k_ == 0:
-                logprobs_list = memory.logprobs
+                logprobs_list = logprobs_with_grad
 
             else:
                 # Evaluating old actions and values :
@@ -892,28 +1238,37 @@ def train_batch(
                             batch_feature, fixed_sol=construct_solution
                         )
 
-                for tt in range(t_time):
-                    # get new action_prob
+                eval_chunk = opts.ppo_eval_chunk if opts.ppo_eval_chunk > 0 else t_time
+                for tt in range(0, t_time, eval_chunk):
+                    # get new action_prob, for eval_chunk steps in one pass
+                    time_steps = min(eval_chunk, t_time - tt)
                     _, log_p, to_critic_, entro_p = agent.actor(
                         problem,
-                        batch_feature,
-                        old_states[tt],
-                        old_pre_actions[tt],
-                        old_action_removal_record[tt],
-                        fixed_action=old_actions[tt],  # take same action
+                        batch_feature.repeat(time_steps, 1, 1),
+                        memory.get_states(tt, tt + time_steps),
+                        old_pre_actions[tt : tt + time_steps].reshape(-1, 3),
+                        memory.get_action_removal_recent(tt, tt + time_steps),
+                        fixed_action=old_actions[tt : tt + time_steps].reshape(
+                            -1, 3
+                        ),  # take same action
                         require_entropy=True,
                         to_critic=True,
+                        time_steps=time_steps,
                     )
 
-                    logprobs_list.append(log_p)
-                    entropy_list.append(entro_p.detach().cpu())
+                    logprobs_list.extend(log_p.view(time_steps, -1).unbind(0))
+                    entropy_list.extend(
+                        entro_p.detach().cpu().view(time_steps, -1).unbind(0)
+                    )
 
                     baseline_val_detached, baseline_val = agent.critic(
-                        to_critic_, old_best_obj[tt]
+                        to_critic_, old_best_obj[tt : tt + time_steps].reshape(-1, 1)
                     )
 
-                    bl_val_detached_list.append(baseline_val_detached)
-                    bl_val_list.append(baseline_val)
+                    bl_val_detached_list.extend(
+                        baseline_val_detached.view(time_steps, -1).unbind(0)
+                    )
+                    bl_val_list.extend(baseline_val.view(time_steps, -1).unbind(0))
 
             logprobs = torch.stack(logprobs_list).view(-1)
             entropy = torch.stack(entropy_list).view(-1)
@@ -935,14 +1290,14 @@ def train_batch(
 
             # get traget value for critic
             Reward_list = []
-            reward_reversed = memory.rewards[::-1]
+            reward_reversed = old_rewards.flip(0)
 
             # estimate return
             R = agent.critic(
                 agent.actor(
                     problem,
                     batch_feature,
-                    solution,
+                    state,
                     action,
                     action_removal_record,
                     only_critic=True,
@@ -1082,7 +1437,7 @@ def train_batch(
                 and k_ == K_epochs - 1
                 and not no_sc_train
             ):
-                is_good = (memory.best_obj[-1].view(-1) < construct_obj).float()
+                is_good = (old_best_obj[-1].view(-1) < construct_obj).float()
                 batch_for_imi = {'coordinates': batch_feature.clone()}
                 batch_augments(
                     opts.cur_imitation_augment, batch_for_imi, one_is_keep=False
@@ -1091,7 +1446,7 @@ def train_batch(
                     'coordinates'
                 ]  # (batch_size, imitation_augment, graph_size_plus1, node_dim)
 
-                # imi_adv = (memory.best_obj[-1].view(-1) - construct_obj).detach()
+                # imi_adv = (old_best_obj[-1].view(-1) - construct_obj).detach()
 
                 for i in range(opts.cur_imitation_augment):
                     _, teaching_logprobs = agent.actor_construct(
@@ -1125,7 +1480,7 @@ def train_batch(
                         bl_val_detached,
                         total_cost,
                         grad_norms,
-                        memory.rewards,
+                        old_rewards,
                         entropy,
                         approx_kl_divergence,
                         reinforce_loss,
@@ -1149,4 +1504,3 @@ def train_batch(
                 pbar.update(1)
 
         # end update
-        memory.clear_memory()
@@ -1,5 +1,6 @@
-from typing import Dict, Optional, Tuple
+from typing import Dict, List, Optional, Sequence, Tuple
 import time
+import math
 import torch
 import os
 import random
@@ -8,9 +9,9 @@ import torch.distributed as dist
 from torch.utils.data import DataLoader
 from tensorboard_logger import Logger as TbLogger
 
-from problems.problem_pdp import PDP
+from problems.problem_pdp import PDP, SliceSampler
 from utils.logger import log_to_screen, log_to_tb_val
-from utils import rotate_tensor, move_to
+from utils import get_dihedral_mats, get_rotate_mat, move_to
 
 from .agent import Agent
 
@@ -54,6 +55,7 @@ def validate(
         num_samples=opts.val_size,
         filename=val_dataset_str,
         silence=mem_test,
+        distance_dtype=opts.distance_dtype,
     )
 
     if distributed:
@@ -91,44 +93,42 @@ def validate(
             )
 
         assert opts.val_batch_size % opts.world_size == 0
-        train_sampler = torch.utils.data.distributed.DistributedSampler(
-            val_dataset, shuffle=False
-        )  # type: ignore
-        val_dataloader = DataLoader(
-            val_dataset,
-            batch_size=opts.val_batch_size // opts.world_size,
-            shuffle=False,
-            num_workers=0,
-            pin_memory=True,
-            sampler=train_sampler,
+        val_sampler = SliceSampler(
+            len(val_dataset),
+            opts.val_batch_size // opts.world_size,
+            opts.world_size,
+            rank,
         )
     else:
-        val_dataloader = DataLoader(
-            val_dataset,
-            batch_size=opts.val_batch_size,
-            shuffle=False,
-            num_workers=0,
-            pin_memory=True,
-        )
+        val_sampler = SliceSampler(len(val_dataset), opts.val_batch_size)
+    val_dataloader = DataLoader(
+        val_dataset,
+        batch_size=None,  # every batch is one slice of the dataset
+        sampler=val_sampler,
+        num_workers=0,
+        pin_memory=True,
+    )
 
     s_time = time.time()
     bv_list = []
     cost_hist_list = []
     best_hist_list = []
     r_list = []
+    steps_list = []
     for batch in tqdm(
         val_dataloader,
         desc='inference',
         bar_format='{l_bar}{bar:20}{r_bar}{bar:-20b}',
         disable=mem_test or (rank != 0),
     ):
-        bv_, cost_hist_, best_hist_, r_ = agent.rollout(
+        bv_, cost_hist_, best_hist_, r_, steps_ = agent.rollout(
             problem, opts.val_m, batch, show_bar=(rank == 0 and not mem_test), zoom=zoom
         )
         bv_list.append(bv_)
         cost_hist_list.append(cost_hist_)
         best_hist_list.append(best_hist_)
         r_list.append(r_)
+        steps_list.append(steps_)
 
         if mem_test:
             break
@@ -136,6 +136,7 @@ def validate(
     cost_hist = torch.cat(cost_hist_list, 0)
     best_hist = torch.cat(best_hist_list, 0)
     r = torch.cat(r_list, 0)
+    steps = torch.cat(steps_list, 0)
 
     if distributed:
         dist.barrier()
@@ -148,6 +149,7 @@ def validate(
         costs_history = gather_tensor_and_concat(cost_hist.contiguous())
         search_history = gather_tensor_and_concat(best_hist.contiguous())
         reward = gather_tensor_and_concat(r.contiguous())
+        steps_used = gather_tensor_and_concat(steps.contiguous())
 
         dist.barrier()
     else:
@@ -157,11 +159,26 @@ def validate(
         costs_history = cost_hist
         search_history = best_hist
         reward = r
+        steps_used = steps
 
     # save costs_history and search_history
+    if opts.time_budget > 0:  # the histories are over fractions of the budget
+        history_steps = []
+        time_fractions: Optional[List[float]] = get_time_fractions(opts.time_points)
+    else:
+        history_steps = get_history_steps(
+            opts.history_mode, opts.T_max, opts.history_steps
+        )
+        time_fractions = None
     if opts.save_infer_dir:
         torch.save(
-            {'current': costs_history, 'best': search_history, 'option': vars(opts)},
+            {
+                'current': costs_history,
+                'best': search_history,
+                'steps': history_steps,
+                'time_fractions': time_fractions,
+                'option': vars(opts),
+            },
             opts.save_infer_dir + '/infer_' + opts.run_name + '.pt',
         )
 
@@ -177,6 +194,9 @@ def validate(
             batch_size=opts.val_size,
             dataset_size=len(val_dataset),
             T=opts.T_max,
+            history_steps=history_steps,
+            steps_used=steps_used,
+            time_fractions=time_fractions,
         )
 
     # log to tb
@@ -193,6 +213,9 @@ def validate(
             val_size=opts.val_size,
             dataset_size=len(val_dataset),
             T=opts.T_max,
+            history_steps=history_steps,
+            steps_used=steps_used,
+            time_fractions=time_fractions,
             epoch=id_,
         )
 
@@ -204,44 +227,189 @@ def validate(
         dist.barrier()
 
 
+def get_history_steps(
+    history_mode: str, T: int, history_steps: Sequence[int] = ()
+) -> List[int]:
+    # the steps whose costs a rollout keeps, step 0 is the initial solution
+    if history_mode == 'full':
+        return list(range(T + 1))
+    elif history_mode == 'checkpoint':
+        if not history_steps:  # the ones read by log_to_screen and log_to_tb_val
+            history_steps = [*range(500, T, 500)] + [
+                round(T * per / 100) for per in range(20, 100, 20)
+            ]
+        return sorted({0, *(step for step in history_steps if 0 <= step <= T)})
+    elif history_mode == 'summary':
+        return [0]
+    else:
+        raise NotImplementedError
+
+
+def get_time_fractions(time_points: int) -> List[float]:
+    # fractions of the time budget a timed rollout records the costs at
+    return [k / time_points for k in range(time_points + 1)]
+
+
+def is_cost_resync_step(t: int, cost_resync_steps: int) -> bool:
+    # whether PDP.step should recompute the whole objective at step t (0-based)
+    return cost_resync_steps > 0 and (t + 1) % cost_resync_steps == 0
+
+
+def reduce_best_solution(
+    best: Optional[Tuple[torch.Tensor, torch.Tensor]],
+    obj: torch.Tensor,  # (batch_size, n_samples)
+    solution: torch.Tensor,  # (batch_size, n_samples, graph_size+1)
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    # fold a chunk of samples into the running (best_obj, best_sol), ties keep the
+    # earlier sample as an argmin over all samples at once would
+    min_sol_index = obj.argmin(dim=1)
+    arange = torch.arange(obj.size(0), device=obj.device)
+    obj = obj[arange, min_sol_index]
+    solution = solution[arange, min_sol_index]
+    if best is None:
+        return obj, solution
+
+    best_obj, best_sol = best
+    is_better = obj < best_obj
+    return (
+        torch.where(is_better, obj, best_obj),  # (batch_size,)
+        torch.where(is_better.unsqueeze(1), solution, best_sol),
+    )
+
+
+def get_best_copy_rows(obj: torch.Tensor, val_m: int) -> torch.Tensor:
+    # for every row of the (batch_size * val_m) augmented batch, the row of the copy
+    # with the lowest obj of its instance, solutions are valid in every view since
+    # the augments only move the coordinates
+    batch_size = obj.size(0) // val_m
+    best_copy = obj.view(batch_size, val_m).argmin(1)
+    best_row = torch.arange(batch_size, device=obj.device) * val_m + best_copy
+    return best_row.repeat_interleave(val_m)  # (batch_size * val_m,)
+
+
+def get_augment_plan(
+    val_m: int,
+    plan: str = 'random',
+    one_is_keep: bool = True,
+    rotations: bool = False,
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    # the transform of each copy, (val_m, 2, 2), and the distinct view it belongs to,
+    # (val_m,), copies of one view only differ in the RNG stream of their search
+    dihedral_mats = get_dihedral_mats()
+    if val_m == 1 and one_is_keep:
+        transform_id = torch.zeros(1, dtype=torch.long)
+    elif plan == 'random':
+        # every copy gets one of the 8 symmetries of the unit square, uniformly,
+        # the same distribution as a random rotation and flips in random order
+        transform_id = torch.randint(8, (val_m,))
+    elif plan == 'distinct':
+        # the 8 symmetries in turn, the first copy keeps the instance
+        transform_id = torch.arange(val_m)
+        if not rotations:
+            transform_id = transform_id % 8
+    else:
+        raise NotImplementedError
+
+    mats = dihedral_mats[transform_id % 8]
+    if rotations and plan == 'distinct' and val_m > 8:
+        # each later round of 8 is also turned by an angle evenly spaced in (0, 90)
+        n_rounds = math.ceil(val_m / 8)
+        rot_mats = torch.stack(
+            [
+                get_rotate_mat(math.pi / 2 * k / n_rounds)
+                for k in range(n_rounds)
+            ]
+        )
+        mats = torch.matmul(mats, rot_mats[transform_id // 8])
+
+    _, view_of_copy = torch.unique(transform_id, return_inverse=True)
+    return mats, view_of_copy.view(-1)
+
+
+def get_view_rows(
+    view_of_copy: torch.Tensor, batch_size: int
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    # rows of the (batch_size * val_m) augmented batch holding the first copy of each
+    # view, and for every row the index of its view among those rows
+    val_m = view_of_copy.size(0)
+    n_views = int(view_of_copy.max()) + 1
+    first_copy = torch.full((n_views,), val_m, dtype=torch.long).scatter_reduce_(
+        0, view_of_copy, torch.arange(val_m), 'amin'
+    )
+    offsets = torch.arange(batch_size).view(-1, 1)
+    return (
+        (offsets * val_m + first_copy).view(-1),  # (batch_size * n_views,)
+        (offsets * n_views + view_of_copy).view(-1),  # (batch_size * val_m,)
+    )
+
+
 def batch_augments(
     val_m: int,
     batch: Dict[str, torch.Tensor],
     graph_size_plus1: Optional[int] = None,
     node_dim: Optional[int] = None,
     one_is_keep: bool = True,
-) -> None:
-    batch['coordinates'] = batch['coordinates'].unsqueeze(1).repeat(1, val_m, 1, 1)
-    augments = ['Rotate', 'Flip_x-y', 'Flip_x_cor', 'Flip_y_cor']
-
-    if val_m > 1 or (not one_is_keep and val_m == 1):
-        for i in range(val_m):
-            random.shuffle(augments)
-            id_ = torch.rand(4)
-            for aug in augments:
-                if aug == 'Rotate':
-                    batch['coordinates'][:, i] = rotate_tensor(
-                        batch['coordinates'][:, i], int(id_[0] * 4 + 1) * 90
-                    )
-                elif aug == 'Flip_x-y':
-                    if int(id_[1] * 2 + 1) == 1:
-                        data = batch['coordinates'][:, i].clone()
-                        batch['coordinates'][:, i, :, 0] = data[:, :, 1]
-                        batch['coordinates'][:, i, :, 1] = data[:, :, 0]
-                elif aug == 'Flip_x_cor':
-                    if int(id_[2] * 2 + 1) == 1:
-                        batch['coordinates'][:, i, :, 0] = (
-                            1 - batch['coordinates'][:, i, :, 0]
-                        )
-                elif aug == 'Flip_y_cor':
-                    if int(id_[3] * 2 + 1) == 1:
-                        batch['coordinates'][:, i, :, 1] = (
-                            1 - batch['coordinates'][:, i, :, 1]
-                        )
+    plan: str = 'random',
+    rotations: bool = False,
+) -> torch.Tensor:
+    coordinates = batch['coordinates']  # (batch_size, graph_size+1, 2)
+
+    mats, view_of_copy = get_augment_plan(val_m, plan, one_is_keep, rotations)
+    if val_m > 1 or not one_is_keep:
+        batch['coordinates'] = (
+            torch.einsum(
+                'bnd,mde->bmne', coordinates - 0.5, mats.to(coordinates.device)
+            )
+            + 0.5
+        ).contiguous()  # (batch_size, val_m, graph_size+1, 2)
+    else:
+        batch['coordinates'] = coordinates.unsqueeze(1).repeat(1, val_m, 1, 1)
 
     if graph_size_plus1 is not None and node_dim is not None:
         batch['coordinates'] = batch['coordinates'].view(-1, graph_size_plus1, node_dim)
 
+    # views turned by angles other than multiples of 90 leave the unit square, the
+    # model sees them shrunk back into it while costs are measured on them as they are
+    input_scale = 1 / mats.abs().sum(1).max(1)[0]  # (val_m,), 1 for the symmetries
+    if (input_scale < 1).any():
+        input_scale = input_scale.to(coordinates.device).repeat(coordinates.size(0))
+        batch['input_scale'] = (
+            input_scale
+            if graph_size_plus1 is not None and node_dim is not None
+            else input_scale.view(-1, val_m)
+        )
+
+    if 'distances' in batch:  # the same in every view, one table per instance
+        distance_rows = torch.arange(
+            coordinates.size(0), device=coordinates.device
+        ).repeat_interleave(val_m)
+        batch['distance_rows'] = (
+            distance_rows
+            if graph_size_plus1 is not None and node_dim is not None
+            else distance_rows.view(-1, val_m)
+        )
+
+    return view_of_copy  # (val_m,)
+
+
+def get_distance_rows(
+    batch: Dict[str, torch.Tensor], repeats: int = 1
+) -> Optional[torch.Tensor]:
+    # the distance table of every row once each row is repeated repeats times in
+    # place, as the samples of the constructor are, None without tables
+    if 'distances' not in batch:
+        return None
+    distance_rows = batch.get('distance_rows')
+    if distance_rows is None:
+        distances = batch['distances']
+        distance_rows = torch.arange(distances.size(0), device=distances.device)
+    return distance_rows.repeat_interleave(repeats)
+
+
+def scale_feature(feature: torch.Tensor, input_scale: torch.Tensor) -> torch.Tensor:
+    # shrink every instance about the centre of the unit square by its input_scale
+    return (feature - 0.5) * input_scale.view(-1, 1, 1) + 0.5
+
 
 def mem_test(agent: Agent, problem: PDP, batch: Dict[str, torch.Tensor]) -> None:
     random_state_backup = (
@@ -277,13 +445,14 @@ def mem_test(agent: Agent, problem: PDP, batch: Dict[str, torch.Tensor]) -> None
 
     print('testing memory restriction for validate...', end=' ')
 
-    opts_backup = opts.T_max, opts.inference_sample_size
+    opts_backup = opts.T_max, opts.inference_sample_size, opts.time_budget
     opts.T_max = 1
     opts.inference_sample_size = min(
         opts.inference_sample_size, opts.inference_sample_batch
     )
+    opts.time_budget = 0  # a budget would run the search past T_max
     validate(0, problem, agent, mem_test=True)
-    opts.T_max, opts.inference_sample_size = opts_backup
+    opts.T_max, opts.inference_sample_size, opts.time_budget = opts_backup
 
     print('pass')
 
@@ -0,0 +1,110 @@
+# Compare the device-resident greedy initial solutions against the original loops,
+# which gathered a distance row from host copies of the coordinates at every step.
+# Run from the repository root: python benchmarks/bench_greedy_init.py
+from typing import Callable
+import os
+import sys
+import time
+import argparse
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from problems.problem_nvrp import NVRP
+from problems.problem_nvta import NVTA
+
+
+def greedy_old(coordinates: torch.Tensor, size: int, lifo: bool) -> torch.Tensor:
+    batch_size = coordinates.size(0)
+    half_size = size // 2
+
+    candidates = torch.ones(batch_size, size + 1).bool()
+    candidates[:, half_size + 1 :] = 0
+    solution = torch.zeros(batch_size, size + 1).long()
+    selected_node = torch.zeros(batch_size, 1).long()
+    candidates.scatter_(1, selected_node, 0)
+    stacks = torch.zeros(batch_size, half_size + 1) - 0.01
+    stacks[:, 0] = 0
+    for i in range(size):
+        if lifo:
+            index1 = (selected_node <= half_size) & (selected_node > 0)
+            if index1.any():
+                stacks[index1.view(-1), selected_node[index1]] = i + 1
+            top = stacks.max(-1)[1]
+
+        d1 = coordinates.cpu().gather(
+            1, selected_node.unsqueeze(-1).expand(batch_size, size + 1, 2)
+        )
+        d2 = coordinates.cpu()
+
+        dists = (d1 - d2).norm(p=2, dim=2)
+        dists[~candidates] = 1e6
+        if lifo:
+            dists[:, size // 2 + 1 :] += 1e3
+            dists[top > 0, top[top > 0] + half_size] -= 1e3
+
+        next_selected_node = dists.min(-1)[1].view(-1, 1)
+
+        if lifo:
+            index2 = (next_selected_node > half_size) & (next_selected_node > 0)
+            if index2.any():
+                stacks[index2.view(-1), next_selected_node[index2] - half_size] = -0.01
+
+        add_index = (next_selected_node <= half_size).view(-1)
+        pairing = next_selected_node[next_selected_node <= half_size].view(-1, 1)
+        candidates[add_index] = candidates[add_index].scatter_(
+            1, pairing + half_size, 1
+        )
+
+        solution.scatter_(1, selected_node, next_selected_node)
+        candidates.scatter_(1, next_selected_node, 0)
+        selected_node = next_selected_node
+
+    return solution.to(coordinates.device)
+
+
+def measure(fn: Callable, repeat: int, coordinates: torch.Tensor) -> float:
+    fn(coordinates)
+    if coordinates.is_cuda:
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn(coordinates)
+    if coordinates.is_cuda:
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / repeat * 1000
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch_size', type=int, default=2000)
+    parser.add_argument('--graph_size', type=int, default=100)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--no_cuda', action='store_true')
+    args = parser.parse_args()
+
+    use_cuda = torch.cuda.is_available() and not args.no_cuda
+    device = torch.device("cuda" if use_cuda else "cpu")
+    torch.manual_seed(1234)
+
+    batch_size, graph_size = args.batch_size, args.graph_size
+    print(f'device: {device}, batch_size: {batch_size}, graph_size: {graph_size}')
+
+    coordinates = torch.rand(batch_size, graph_size + 1, 2, device=device)
+    for problem_class, lifo in ((NVRP, False), (NVTA, True)):
+        problem = problem_class(graph_size, 'greedy')
+        batch = {'coordinates': coordinates}
+
+        assert torch.equal(
+            greedy_old(coordinates, graph_size, lifo),
+            problem.get_initial_solutions(batch),
+        )
+
+        for tag, fn in (
+            ('old', lambda c: greedy_old(c, graph_size, lifo)),
+            ('new', lambda c: problem.get_initial_solutions({'coordinates': c})),
+        ):
+            elapsed = measure(fn, args.repeat, coordinates)
+            print(
+                '{} greedy {}: {:8.3f} ms'.format(problem_class.__name__, tag, elapsed)
+            )
@@ -0,0 +1,122 @@
+# Compare the broadcast swap masks (applied with masked_fill_) against the original
+# clone + index-assign masks that were copied to host before being applied.
+# Run from the repository root: python benchmarks/bench_swap_mask.py
+from typing import Callable, Optional, Tuple
+import os
+import sys
+import time
+import argparse
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from problems.problem_pdp import PDP
+from problems.problem_nvrp import NVRP
+from problems.problem_nvta import NVTA
+
+
+def swap_mask_nvrp_old(
+    selected_node: torch.Tensor, visit_index: torch.Tensor, top2: Optional[torch.Tensor]
+) -> torch.Tensor:
+    visited_order_map = PDP._get_visit_order_map(visit_index)
+    batch_size, graph_size_plus1, _ = visited_order_map.size()
+
+    mask = visited_order_map.clone()
+    arange = torch.arange(batch_size)
+    mask[arange, selected_node.view(-1)] = True
+    mask[arange, selected_node.view(-1) + graph_size_plus1 // 2] = True
+    mask[arange, :, selected_node.view(-1)] = True
+    mask[arange, :, selected_node.view(-1) + graph_size_plus1 // 2] = True
+    return mask
+
+
+def swap_mask_nvta_old(
+    selected_node: torch.Tensor, visit_index: torch.Tensor, top2: torch.Tensor
+) -> torch.Tensor:
+    graph_size_plus1 = visit_index.size(1)
+    top = torch.where(top2[:, :, 0] == selected_node, top2[:, :, 1], top2[:, :, 0])
+    mask_pd = top.view(-1, graph_size_plus1, 1) != top.view(-1, 1, graph_size_plus1)
+    return swap_mask_nvrp_old(selected_node, visit_index, top2) | mask_pd
+
+
+def apply_old(
+    get_swap_mask: Callable, table: torch.Tensor, *args: torch.Tensor
+) -> torch.Tensor:
+    mask_table = get_swap_mask(*args).cpu()
+    table[mask_table] = -1e20
+    return table
+
+
+def apply_new(
+    get_swap_mask: Callable, table: torch.Tensor, *args: torch.Tensor
+) -> torch.Tensor:
+    return table.masked_fill_(get_swap_mask(*args), -1e20)
+
+
+def measure(fn: Callable, repeat: int, *args) -> Tuple[float, float]:
+    fn(*args)
+    cuda = torch.cuda.is_available() and args[1].is_cuda
+    if cuda:
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+        base = torch.cuda.memory_allocated()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn(*args)
+    if cuda:
+        torch.cuda.synchronize()
+    elapsed = (time.perf_counter() - start) / repeat * 1000
+    peak = (torch.cuda.max_memory_allocated() - base) / 2**20 if cuda else float('nan')
+    return elapsed, peak
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch_size', type=int, default=2000)
+    parser.add_argument('--graph_size', type=int, default=100)
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--no_cuda', action='store_true')
+    args = parser.parse_args()
+
+    use_cuda = torch.cuda.is_available() and not args.no_cuda
+    device = torch.device("cuda" if use_cuda else "cpu")
+    torch.manual_seed(1234)
+
+    batch_size, graph_size = args.batch_size, args.graph_size
+    print(f'device: {device}, batch_size: {batch_size}, graph_size: {graph_size}')
+    print('peak memory is only reported on cuda')
+
+    for problem, old in ((NVRP, swap_mask_nvrp_old), (NVTA, swap_mask_nvta_old)):
+        solution = problem(graph_size, 'random').get_initial_solutions(
+            {'coordinates': torch.zeros(batch_size, graph_size + 1, 2)}
+        )
+        solution = solution.to(device)
+        visit_index = PDP.get_visit_index(solution)
+        top2 = PDP.get_stack_top2(visit_index)
+        selected_node = torch.randint(1, graph_size // 2 + 1, (batch_size, 1))
+        selected_node = selected_node.to(device)
+        table = torch.rand(batch_size, graph_size + 1, graph_size + 1, device=device)
+
+        assert torch.equal(
+            old(selected_node, visit_index, top2),
+            problem.get_swap_mask(selected_node, visit_index, top2),
+        )
+
+        for tag, fn, get_swap_mask in (
+            ('mask', lambda f, t, *a: f(*a), old),
+            ('mask', lambda f, t, *a: f(*a), problem.get_swap_mask),
+            ('mask+apply', apply_old, old),
+            ('mask+apply', apply_new, problem.get_swap_mask),
+        ):
+            elapsed, peak = measure(
+                fn, args.repeat, get_swap_mask, table, selected_node, visit_index, top2
+            )
+            print(
+                '{} {:10s} {:3s}: {:8.3f} ms, peak {:8.1f} MiB'.format(
+                    problem.__name__,
+                    tag,
+                    'old' if get_swap_mask is old else 'new',
+                    elapsed,
+                    peak,
+                )
+            )
@@ -0,0 +1,136 @@
+# Compare the loop-free visit order / stack tops against the original per-node walk.
+# Run from the repository root: python benchmarks/bench_visit_order.py
+from typing import Optional, Tuple
+import os
+import sys
+import time
+import argparse
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from problems.problem_pdp import PDP
+
+
+def visit_order_loop(
+    solution: torch.Tensor, calc_stacks: bool
+) -> Tuple[torch.Tensor, Optional[torch.Tensor]]:
+    # the walk previously used in EmbeddingNet._position_embedding
+    batch_size, seq_length = solution.size()
+    half_size = seq_length // 2
+    visit_index = torch.zeros((batch_size, seq_length), device=solution.device)
+    pre = torch.zeros((batch_size), device=solution.device).long()
+
+    arange = torch.arange(batch_size)
+    if calc_stacks:
+        stacks = torch.zeros(batch_size, half_size + 1, device=solution.device)
+        stacks -= 0.01
+        top2 = torch.zeros(batch_size, seq_length, 2, device=solution.device).long()
+        stacks[arange, pre] = 0
+
+    for i in range(seq_length):
+        current_nodes = solution[arange, pre]
+        visit_index[arange, current_nodes] = i + 1
+        pre = current_nodes
+
+        if calc_stacks:
+            index1 = (current_nodes <= half_size) & (current_nodes > 0)
+            index2 = (current_nodes > half_size) & (current_nodes > 0)
+            if index1.any():
+                stacks[index1, current_nodes[index1]] = i + 1
+            if index2.any():
+                stacks[index2, current_nodes[index2] - half_size] = -0.01
+            top2[arange, current_nodes] = stacks.topk(2)[1]
+
+    return (visit_index % seq_length).long(), top2 if calc_stacks else None
+
+
+def visit_order_vectorized(
+    solution: torch.Tensor, calc_stacks: bool
+) -> Tuple[torch.Tensor, Optional[torch.Tensor]]:
+    visit_index = PDP.get_visit_index(solution)
+    return visit_index, PDP.get_stack_top2(visit_index) if calc_stacks else None
+
+
+def random_solutions(
+    batch_size: int, graph_size: int, lifo: bool, device: torch.device
+) -> torch.Tensor:
+    # random feasible tours: pickups before deliveries (LIFO order if requested)
+    half_size = graph_size // 2
+    tours = []
+    for _ in range(batch_size):
+        order = torch.randperm(half_size) + 1
+        tour, stack, opened = [], [], 0
+        while len(tour) < graph_size:
+            if opened < half_size and (not stack or torch.rand(1).item() < 0.5):
+                tour.append(order[opened].item())
+                stack.append(order[opened].item())
+                opened += 1
+            else:
+                k = len(stack) - 1 if lifo else torch.randint(len(stack), (1,)).item()
+                node = stack.pop(k)
+                tour.append(node + half_size)
+        tours.append(tour)
+
+    tours = torch.tensor(tours, device=device)
+    depot = torch.zeros_like(tours[:, :1])
+    solution = torch.zeros(batch_size, graph_size + 1, dtype=torch.long, device=device)
+    solution.scatter_(1, torch.cat((depot, tours), 1), torch.cat((tours, depot), 1))
+    return solution
+
+
+def top2_equal(top2: torch.Tensor, top2_new: torch.Tensor) -> bool:
+    # the second entry is a tie among the empty slots when the stack is empty,
+    # and topk gives no order among ties, so it is only compared otherwise
+    has_stack = top2[:, :, 0] > 0
+    return torch.equal(top2[:, :, 0], top2_new[:, :, 0]) and torch.equal(
+        top2[:, :, 1][has_stack], top2_new[:, :, 1][has_stack]
+    )
+
+
+def timeit(fn, solution: torch.Tensor, calc_stacks: bool, repeat: int) -> float:
+    fn(solution, calc_stacks)
+    if solution.is_cuda:
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn(solution, calc_stacks)
+    if solution.is_cuda:
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / repeat * 1000
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch_size', type=int, default=512)
+    parser.add_argument(
+        '--graph_sizes', type=int, nargs='+', default=[20, 50, 100, 200]
+    )
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--no_cuda', action='store_true')
+    args = parser.parse_args()
+
+    use_cuda = torch.cuda.is_available() and not args.no_cuda
+    device = torch.device("cuda" if use_cuda else "cpu")
+    torch.manual_seed(1234)
+
+    print('device: {}, batch_size: {}'.format(device, args.batch_size))
+    for graph_size in args.graph_sizes:
+        for calc_stacks in (False, True):
+            solution = random_solutions(
+                args.batch_size, graph_size, calc_stacks, device
+            )
+
+            visit_index, top2 = visit_order_loop(solution, calc_stacks)
+            visit_index_new, top2_new = visit_order_vectorized(solution, calc_stacks)
+            assert torch.equal(visit_index, visit_index_new)
+            assert top2 is None or top2_equal(top2, top2_new)
+
+            t_loop = timeit(visit_order_loop, solution, calc_stacks, args.repeat)
+            t_new = timeit(visit_order_vectorized, solution, calc_stacks, args.repeat)
+            print(
+                'graph_size {:4d} stacks {:d}: loop {:8.3f} ms, '
+                'vectorized {:8.3f} ms ({:.1f}x), identical'.format(
+                    graph_size, calc_stacks, t_loop, t_new, t_loop / t_new
+                )
+            )
@@ -1,9 +1,9 @@
-from typing import Callable, Dict, List, Optional, Tuple, Union, TYPE_CHECKING
+from typing import Callable, Dict, Optional, Tuple, Union, TYPE_CHECKING
 import math
 from torch import nn
 import torch
 
-from problems.problem_pdp import PDP
+from problems.problem_pdp import PDP, SolutionState, ActionRemovalRecord
 
 from .graph_layers import (
     NNSEncoder,
@@ -47,6 +47,8 @@ class Actor_NNS(nn.Module):
         seq_length: int,
         embedding_type: str,
         removal_type: str,
+        reinsertion_chunk_size: int = 0,
+        sparse_reinsertion: bool = False,
     ) -> None:
         super().__init__()
 
@@ -82,7 +84,12 @@ class Actor_NNS(nn.Module):
         )  # for NFEs
 
         self.decoder = NNSDecoder(
-            self.n_heads_actor, self.embedding_dim, self.v_range, removal_type
+            self.n_heads_actor,
+            self.embedding_dim,
+            self.v_range,
+            removal_type,
+            reinsertion_chunk_size,
+            sparse_reinsertion,
         )  # the two propsoed decoders
 
         print('Actor_NNS:', self.get_parameter_number())
@@ -94,18 +101,11 @@ class Actor_NNS(nn.Module):
 
     @staticmethod
     def _get_action_removal_recent(
-        action_removal_record: List[torch.Tensor],
+        action_removal_record: Union[ActionRemovalRecord, torch.Tensor],
     ) -> torch.Tensor:
-        action_removal_record_tensor = torch.stack(
-            action_removal_record
-        )  # (len_action_record, batch_size, graph_size/2)
-        return torch.cat(
-            (
-                action_removal_record_tensor[-3:].transpose(0, 1),
-                action_removal_record_tensor.mean(0).unsqueeze(1),
-            ),
-            1,
-        )  # (batch_size, 4, graph_size/2)
+        if isinstance(action_removal_record, ActionRemovalRecord):
+            return action_removal_record.recent()
+        return action_removal_record  # already (batch_size, 4, graph_size/2)
 
     __call__: Callable[
         ..., Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]
@@ -115,14 +115,17 @@ class Actor_NNS(nn.Module):
         self,
         problem: PDP,
         x_in: torch.Tensor,
-        solution: torch.Tensor,
+        solution: SolutionState,
         pre_action: Optional[torch.Tensor],
-        action_removal_record: List[torch.Tensor],
+        action_removal_record: Union[ActionRemovalRecord, torch.Tensor],
         fixed_action: Optional[torch.Tensor] = None,
         require_entropy: bool = False,
         to_critic: bool = False,
         only_critic: bool = False,
         only_fea: bool = False,
+        time_steps: int = 1,  # > 1 when the batch stacks the states of many steps
+        distances: Optional[torch.Tensor] = None,  # precomputed by the dataset
+        distance_rows: Optional[torch.Tensor] = None,  # table of each row
     ):
         # the embedded input x
         # batch_size, graph_size+1, node_dim = x_in.size()
@@ -132,8 +135,10 @@ class Actor_NNS(nn.Module):
             return h_fea.detach(), None, None, None
 
         h_fea, g_pos, visit_index, top2 = self.embedder(
-            x_in, solution, self.calc_stacks
+            x_in, solution.post, self.calc_stacks, solution.visit_index, solution.top2
         )
+        # keep them on the state, PDP.step updates them along with the move
+        solution.visit_index, solution.top2 = visit_index, top2
 
         if h_fea is None:  # share or together
             h_fea = self.agent.actor_construct(x_in, only_fea=True)[0]
@@ -156,9 +161,12 @@ class Actor_NNS(nn.Module):
             pre_action=pre_action,
             selection_recent=Actor_NNS._get_action_removal_recent(
                 action_removal_record
-            ).to(x_in.device),
+            ),
             fixed_action=fixed_action,
             require_entropy=require_entropy,
+            time_steps=time_steps,
+            distances=distances,
+            distance_rows=distance_rows,
         )
 
         return (
@@ -227,36 +235,54 @@ class Actor_Construct(nn.Module):  # kool suggest 8 heads and 128 dim
         only_fea: bool = False,
     ):
 
-        if self.embedder is None:  # share
-            h_fea = self.agent.actor(None, x_in, None, None, None, only_fea=True)[0]
-        else:
-            h_fea = self.embedder(x_in)  # (batch_size, graph_size+1, embedding_dim)
-
         if only_fea:
+            h_fea = self._embed(x_in)
             return h_fea if self.together else h_fea.detach(), None
 
-        hN: torch.Tensor = self.encoder(h_fea)
-        hN_mean = hN.mean(1)
+        hN, hN_mean = self.encode(x_in)
+
+        return self.decode(hN, hN_mean, 1, fixed_sol, temperature)
 
-        batch_size, graph_size_plus1, _ = h_fea.size()
+    def _embed(self, x_in: torch.Tensor) -> torch.Tensor:
+        if self.embedder is None:  # share
+            return self.agent.actor(None, x_in, None, None, None, only_fea=True)[0]
+        return self.embedder(x_in)  # (batch_size, graph_size+1, embedding_dim)
 
-        init_sol = (
-            torch.arange(graph_size_plus1).repeat((batch_size, 1)).to(h_fea.device)
+    def encode(self, x_in: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        hN: torch.Tensor = self.encoder(self._embed(x_in))
+        return hN, hN.mean(1)  # (batch_size, graph_size+1, embedding_dim), pooled
+
+    def decode(
+        self,
+        hN: torch.Tensor,
+        hN_mean: torch.Tensor,
+        n_samples: int = 1,
+        fixed_sol: Optional[torch.Tensor] = None,
+        temperature: float = 1,
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        # n_samples solutions per instance, all attending to the same hN
+        # rows are ordered as (batch_size, n_samples)
+        batch_size, graph_size_plus1, _ = hN.size()
+        n_rows = batch_size * n_samples
+
+        init_sol = torch.arange(graph_size_plus1, device=hN.device).repeat(
+            (n_rows, 1)
         )
         cur_sol = init_sol.clone()
+        cur_node = torch.zeros(n_rows, dtype=torch.long, device=hN.device)
 
-        stack = (
-            torch.zeros((batch_size, graph_size_plus1 // 2 + 1)).to(h_fea.device) - 1
-        )
+        stack = torch.zeros((n_rows, graph_size_plus1 // 2 + 1), device=hN.device) - 1
         stack[:, 0] = 0
 
         direct_fixed_sol = (
             PDP.direct_solution(fixed_sol) if fixed_sol is not None else None
         )
 
+        cache = self.decoder.precompute(hN)  # keys and values for all steps
+
         log_ll_list = []
         for step in range(graph_size_plus1 - 1):
-            cur_sol, log_p = self.decoder(
+            cur_sol, log_p, cur_node = self.decoder(
                 hN,
                 hN_mean,
                 cur_sol,
@@ -265,10 +291,12 @@ class Actor_Construct(nn.Module):  # kool suggest 8 heads and 128 dim
                 stack,
                 direct_fixed_sol,
                 temperature,
+                cur_node,
+                cache,
             )
             log_ll_list.append(log_p.view(-1))
 
-        log_ll = torch.stack(log_ll_list, 1).sum(1)  # (batch_size,)
+        log_ll = torch.stack(log_ll_list, 1).sum(1)  # (batch_size*n_samples,)
 
         return cur_sol, log_ll
 
@@ -1,4 +1,5 @@
 from typing import Callable, Optional, Tuple
+from functools import partial
 import torch
 import torch.nn.functional as F
 from torch.distributions import Categorical
@@ -6,7 +7,7 @@ import numpy as np
 from torch import nn
 import math
 
-from problems.problem_pdp import PDP
+from problems.problem_pdp import PDP, SolutionState
 
 TYPE_REMOVAL = 'NNS'
 # TYPE_REMOVAL = 'random'
@@ -77,41 +78,56 @@ class MultiHeadAttention(nn.Module):
         if self.in_val_dim is None:  # calculate attention score
             assert v is None
 
-        batch_size, n_query, in_que_dim = q.size()
-        _, n_key, in_key_dim = k.size()
+        K, V = self.precompute_kv(k, v)
+        return self.forward_with_kv(q, K, V, with_norm)
+
+    def precompute_kv(
+        self, k: torch.Tensor, v: Optional[torch.Tensor] = None
+    ) -> Tuple[torch.Tensor, Optional[torch.Tensor]]:
+        # keys and values only depend on k and v, can be reused across queries
+        batch_size, n_key, in_key_dim = k.size()
+
+        kflat = k.contiguous().view(-1, in_key_dim)  # (batch_size * n_key, in_key_dim)
+        shp_kv = (self.n_heads, batch_size, n_key, self.hidden_dim)
+
+        # Calculate keys and values (n_heads, batch_size, n_key, hidden_dim)
+        K = torch.matmul(kflat, self.W_key).view(shp_kv)
+        if v is None:
+            return K, None
+
+        vflat = v.contiguous().view(-1, v.size(2))
+        V = torch.matmul(vflat, self.W_val).view(shp_kv)
+        return K, V
 
-        if v is not None:
-            in_val_dim = v.size(2)
+    def forward_with_kv(
+        self,
+        q: torch.Tensor,
+        K: torch.Tensor,  # (n_heads, batch_size, n_key, hidden_dim)
+        V: Optional[torch.Tensor] = None,  # (n_heads, batch_size, n_key, hidden_dim)
+        with_norm: bool = False,
+    ) -> torch.Tensor:
+        batch_size, n_query, in_que_dim = q.size()
 
         qflat = q.contiguous().view(
             -1, in_que_dim
         )  # (batch_size * n_query, in_que_dim)
-        kflat = k.contiguous().view(-1, in_key_dim)  # (batch_size * n_key, in_key_dim)
-        if v is not None:
-            vflat = v.contiguous().view(-1, in_val_dim)
 
         shp_q = (self.n_heads, batch_size, n_query, self.hidden_dim)
-        shp_kv = (self.n_heads, batch_size, n_key, self.hidden_dim)
 
         # Calculate queries, (n_heads, batch_size, n_query, hidden_dim)
         Q = torch.matmul(qflat, self.W_query).view(shp_q)
         # self.W_que: (n_heads, in_que_dim, hidden_dim)
         # Q_before_view: (n_heads, batch_size * n_query, hidden_dim)
 
-        # Calculate keys and values (n_heads, batch_size, n_key, hidden_dim)
-        K = torch.matmul(kflat, self.W_key).view(shp_kv)
-        if v is not None:
-            V = torch.matmul(vflat, self.W_val).view(shp_kv)
-
         # Calculate compatibility (n_heads, batch_size, n_query, n_key)
         compatibility = torch.matmul(Q, K.transpose(2, 3))
 
-        if v is None and not with_norm:
+        if V is None and not with_norm:
             return compatibility
 
         compatibility = self.norm_factor * compatibility
 
-        if v is None and with_norm:
+        if V is None and with_norm:
             return compatibility
 
         attn = F.softmax(compatibility, dim=-1)
@@ -187,6 +203,30 @@ class MLP(nn.Module):
         result = self.fc3(result).squeeze(-1)
         return result
 
+    def forward_pairwise(
+        self,
+        input_row: torch.Tensor,  # (batch_size, n_row, row_dim)
+        input_column: torch.Tensor,  # (batch_size, n_column, input_dim-row_dim)
+        chunk_size: int,
+    ) -> torch.Tensor:
+        # same as forward on cat((input_row[:, i], input_column[:, j]), -1) for all
+        # (i, j), fc1 is split in two so only chunk_size rows are expanded at a time
+        row_dim = input_row.size(-1)
+        hidden_row = F.linear(
+            input_row, self.fc1.weight[:, :row_dim], self.fc1.bias
+        ).unsqueeze(2)  # (batch_size, n_row, 1, feed_forward_dim)
+        hidden_column = F.linear(
+            input_column, self.fc1.weight[:, row_dim:]
+        ).unsqueeze(1)  # (batch_size, 1, n_column, feed_forward_dim)
+
+        results = []
+        for i in range(0, input_row.size(1), chunk_size):
+            result = self.ReLU(hidden_row[:, i : i + chunk_size] + hidden_column)
+            result = self.dropout(result)
+            result = self.ReLU(self.fc2(result))
+            results.append(self.fc3(result).squeeze(-1))
+        return torch.cat(results, 1)  # (batch_size, n_row, n_column)
+
 
 class CriticDecoder(nn.Module):
     def __init__(self, input_dim: int) -> None:
@@ -276,15 +316,15 @@ class NodePairRemovalDecoder(nn.Module):  # (12) (13)
     def forward(
         self,
         h_hat: torch.Tensor,  # hidden state from encoder
-        solution: torch.Tensor,  # if solution=[2,0,1], means 0->2->1->0.
+        solution: SolutionState,
         selection_recent: torch.Tensor,  # (batch_size, 4, graph_size/2)
     ) -> torch.Tensor:
 
-        pre = solution.argsort()  # pre=[1,2,0]
-        post = solution  # post=[2,0,1]
+        pre = solution.pre  # pre=[1,2,0]
+        post = solution.post  # post=[2,0,1]
 
         if self.type_ == 'glitch':
-            post = solution.gather(1, solution)  # use post-post
+            post = post.gather(1, post)  # use post-post
 
         batch_size, graph_size_plus1, input_dim = h_hat.size()
 
@@ -309,10 +349,10 @@ class NodePairRemovalDecoder(nn.Module):  # (12) (13)
             half_size = graph_size_plus1 // 2
 
             pre_pre = pre.gather(1, pre)
-            post_post = solution.gather(1, solution)
+            post_post = solution.post.gather(1, solution.post)
 
             if self.pair_with is None:
-                self.pair_with = torch.arange(graph_size_plus1, device=solution.device)
+                self.pair_with = torch.arange(graph_size_plus1, device=pre.device)
                 self.pair_with[1 : half_size + 1] += half_size
                 self.pair_with[half_size + 1 :] -= half_size
 
@@ -343,7 +383,7 @@ class NodePairRemovalDecoder(nn.Module):  # (12) (13)
         ]  # (n_heads, batch_size, graph_size) (12)
 
         if self.type_ == 'update2':
-            post_post = solution.gather(1, solution)
+            post_post = solution.post.gather(1, solution.post)
 
             hidden_Q_2 = torch.matmul(hflat, self.W_Q_2).view(shp)
             hidden_K_2 = torch.matmul(hflat, self.W_K_2).view(shp)
@@ -418,16 +458,17 @@ class NodePairRemovalDecoder(nn.Module):  # (12) (13)
                 ),
                 -1,
             )
-        ).squeeze()  # (batch_size, graph_size/2)
+        ).squeeze(-1)  # (batch_size, graph_size/2)
 
         return compatibility_pairing
 
 
 class NodePairReinsertionDecoder(nn.Module):  # (14) (15)
-    def __init__(self, n_heads: int, input_dim: int) -> None:
+    def __init__(self, n_heads: int, input_dim: int, chunk_size: int = 0) -> None:
         super().__init__()
 
         self.n_heads = n_heads
+        self.chunk_size = chunk_size  # 0: score all the cells at once
 
         self.compater_insert1 = MultiHeadAttention(
             n_heads, input_dim, input_dim, None, input_dim * n_heads
@@ -453,6 +494,7 @@ class NodePairReinsertionDecoder(nn.Module):  # (14) (15)
         pos_pickup: torch.Tensor,  # (batch_size)
         pos_delivery: torch.Tensor,  # (batch_size)
         solution: torch.Tensor,  # (batch, graph_size+1)
+        cells: Optional[torch.Tensor] = None,  # (n_cells, 3), only score these
     ) -> torch.Tensor:
 
         batch_size, graph_size_plus1, input_dim = h_hat.size()
@@ -469,6 +511,39 @@ class NodePairReinsertionDecoder(nn.Module):  # (14) (15)
             1, solution.view(batch_size, graph_size_plus1, 1).expand_as(h_hat)
         )  # (batch_size, graph_size+1, input_dim)
 
+        if cells is not None or self.chunk_size > 0:
+            # pickup terms only vary along rows, delivery terms along columns
+            compatibility_pickup = torch.cat(
+                (
+                    self.compater_insert1(h_pickup, h_hat),
+                    self.compater_insert2(h_pickup, h_K_neibour),
+                ),
+                0,
+            ).permute(1, 2, 3, 0)[:, 0]  # (batch_size, graph_size+1, 2*n_heads)
+            compatibility_delivery = torch.cat(
+                (
+                    self.compater_insert1(h_delivery, h_hat),
+                    self.compater_insert2(h_delivery, h_K_neibour),
+                ),
+                0,
+            ).permute(1, 2, 3, 0)[:, 0]
+
+            if cells is not None:
+                batch_index, pickup_after, delivery_after = cells.unbind(1)
+                return self.agg(
+                    torch.cat(
+                        (
+                            compatibility_pickup[batch_index, pickup_after],
+                            compatibility_delivery[batch_index, delivery_after],
+                        ),
+                        -1,
+                    )
+                )  # (n_cells,)
+
+            return self.agg.forward_pairwise(
+                compatibility_pickup, compatibility_delivery, self.chunk_size
+            )  # (batch_size, graph_size+1, graph_size+1)
+
         compatibility_pickup_pre = (
             self.compater_insert1(
                 h_pickup, h_hat
@@ -508,24 +583,33 @@ class NodePairReinsertionDecoder(nn.Module):  # (14) (15)
                 ),
                 -1,
             )
-        ).squeeze()
+        ).squeeze(-1)
         return compatibility  # (batch_size, graph_size+1, graph_size+1)
 
 
 class NNSDecoder(nn.Module):
     def __init__(
-        self, n_heads: int, input_dim: int, v_range: float, removal_type: str
+        self,
+        n_heads: int,
+        input_dim: int,
+        v_range: float,
+        removal_type: str,
+        reinsertion_chunk_size: int = 0,
+        sparse_reinsertion: bool = False,
     ) -> None:
         super().__init__()
         self.input_dim = input_dim
         self.v_range = v_range
+        self.sparse_reinsertion = sparse_reinsertion
 
         if TYPE_REMOVAL == 'NNS':
             self.compater_removal = NodePairRemovalDecoder(
                 n_heads, input_dim, removal_type
             )
         if TYPE_REINSERTION == 'NNS':
-            self.compater_reinsertion = NodePairReinsertionDecoder(n_heads, input_dim)
+            self.compater_reinsertion = NodePairReinsertionDecoder(
+                n_heads, input_dim, reinsertion_chunk_size
+            )
 
         self.project_graph = nn.Linear(self.input_dim, self.input_dim, bias=False)
         self.project_node = nn.Linear(self.input_dim, self.input_dim, bias=False)
@@ -536,13 +620,94 @@ class NNSDecoder(nn.Module):
             stdv = 1.0 / math.sqrt(param.size(-1))
             param.data.uniform_(-stdv, stdv)
 
+    def _sparse_reinsertion(
+        self,
+        h_hat: torch.Tensor,  # (batch_size, graph_size+1, input_dim)
+        pos_pickup: torch.Tensor,  # (batch_size)
+        pos_delivery: torch.Tensor,  # (batch_size)
+        solution: torch.Tensor,  # (batch_size, graph_size+1)
+        mask_table: torch.Tensor,  # (batch_size, graph_size+1, graph_size+1)
+        fixed_action: Optional[torch.Tensor],
+        require_entropy: bool,
+    ) -> Tuple[torch.Tensor, torch.Tensor, Optional[torch.Tensor]]:
+        batch_size, graph_size_plus1, _ = h_hat.size()
+
+        # feasible cells packed instance by instance, as (batch, pickup, delivery)
+        cells = (~mask_table).nonzero()  # (n_cells, 3)
+        batch_index = cells[:, 0]
+        ends = torch.bincount(batch_index, minlength=batch_size).cumsum(0)
+        starts = torch.cat((ends.new_zeros(1), ends[:-1]))
+
+        logits = (
+            torch.tanh(
+                self.compater_reinsertion(
+                    h_hat, pos_pickup, pos_delivery, solution, cells
+                )
+            )
+            * self.v_range
+        )  # (n_cells,)
+
+        # softmax within every instance
+        logits_max = logits.new_full((batch_size,), -math.inf).scatter_reduce(
+            0, batch_index, logits.detach(), 'amax'
+        )
+        logits = logits - logits_max[batch_index]
+        log_sum_exp = (
+            logits.new_zeros(batch_size).index_add(0, batch_index, logits.exp()).log()
+        )
+        log_probs = logits - log_sum_exp[batch_index]
+        probs = log_probs.exp()
+
+        if fixed_action is not None:
+            pair_index = (
+                fixed_action[:, 1] * graph_size_plus1 + fixed_action[:, 2]
+            ).view(-1, 1)
+            selected = (
+                cells[:, 1] * graph_size_plus1 + cells[:, 2]
+                == pair_index[batch_index, 0]
+            )
+            selected_log_ll = log_probs.new_zeros(batch_size).index_add(
+                0, batch_index, log_probs.masked_fill(~selected, 0)
+            )
+        else:
+            # inverse transform sampling, one uniform number per instance
+            cdf = probs.detach().double().cumsum(0)
+            cdf_start = torch.where(starts > 0, cdf[(starts - 1).clamp(min=0)], 0.0)
+            target = cdf_start + torch.rand(
+                batch_size, dtype=cdf.dtype, device=cdf.device
+            ) * (cdf[ends - 1] - cdf_start)
+            picked = torch.minimum(
+                torch.searchsorted(cdf, target, right=True), ends - 1
+            )
+            pair_index = (cells[picked, 1] * graph_size_plus1 + cells[picked, 2]).view(
+                -1, 1
+            )
+            selected_log_ll = log_probs[picked]
+
+        if require_entropy and self.training:
+            entropy = -logits.new_zeros(batch_size).index_add(
+                0, batch_index, probs * log_probs
+            )
+        else:
+            entropy = None
+
+        return (
+            pair_index,  # (batch_size, 1)
+            (
+                selected_log_ll.unsqueeze(1)
+                if self.training
+                else torch.tensor(0).to(h_hat.device)
+            ),
+            entropy,
+        )
+
     __call__: Callable[..., Tuple[torch.Tensor, torch.Tensor, torch.Tensor]]
 
     def forward(
         self,
         problem: PDP,
         h_wave: torch.Tensor,
-        solution: torch.Tensor,
+        solution: SolutionState,
         x_in: torch.Tensor,
         top2: torch.Tensor,
         visit_index: torch.Tensor,
@@ -550,13 +715,14 @@ class NNSDecoder(nn.Module):
         selection_recent: torch.Tensor,
         fixed_action: Optional[torch.Tensor],
         require_entropy: bool,
+        time_steps: int = 1,  # steps stacked along the batch, each with its own rule
+        distances: Optional[torch.Tensor] = None,  # for the greedy heuristics
+        distance_rows: Optional[torch.Tensor] = None,
     ):
 
         batch_size, graph_size_plus1, input_dim = h_wave.size()
         half_pos = (graph_size_plus1 - 1) // 2
 
-        arange = torch.arange(batch_size)
-
         h_hat: torch.Tensor = self.project_node(h_wave) + self.project_graph(
             h_wave.max(1)[0]
         )[:, None, :].expand(
@@ -567,12 +733,20 @@ class NNSDecoder(nn.Module):
         if TYPE_REMOVAL == 'NNS':
             action_removal_table = (
                 torch.tanh(
-                    self.compater_removal(h_hat, solution, selection_recent).squeeze()
+                    self.compater_removal(h_hat, solution, selection_recent).squeeze(-1)
                 )
                 * self.v_range
             )
-            if pre_action is not None and pre_action[0, 0] > 0:
-                action_removal_table[arange, pre_action[:, 0]] = -1e20
+            if pre_action is not None:
+                # the previous removal is masked if the first one of its step is > 0
+                mask_pre = (pre_action.view(time_steps, -1)[:, :1] > 0).expand(
+                    time_steps, batch_size // time_steps
+                )
+                action_removal_table = action_removal_table.masked_fill(
+                    F.one_hot(pre_action[:, 0].clamp(min=0), half_pos).bool()
+                    & mask_pre.reshape(batch_size, 1),
+                    -1e20,
+                )
             log_ll_removal = (
                 F.log_softmax(action_removal_table, dim=-1) if self.training else None
             )  # log-likelihood
@@ -584,28 +758,22 @@ class NNSDecoder(nn.Module):
         elif TYPE_REMOVAL == 'greedy':
             # epi-greedy
             first_row = (
-                torch.arange(graph_size_plus1, device=solution.device)
+                torch.arange(graph_size_plus1, device=x_in.device)
                 .long()
                 .unsqueeze(0)
                 .expand(batch_size, graph_size_plus1)
             )
-            d_i = x_in.gather(
-                1, first_row.unsqueeze(-1).expand(batch_size, graph_size_plus1, 2)
-            )
-            d_i_next = x_in.gather(
-                1, solution.long().unsqueeze(-1).expand(batch_size, graph_size_plus1, 2)
-            )
-            d_i_pre = x_in.gather(
-                1,
-                solution.argsort()
-                .long()
-                .unsqueeze(-1)
-                .expand(batch_size, graph_size_plus1, 2),
+            edge_lengths = partial(
+                PDP._get_edge_lengths,
+                x_in,
+                distances=distances,
+                distance_rows=distance_rows,
             )
+            post, pre = solution.post.long(), solution.pre.long()
             cost_ = (
-                (d_i_pre - d_i).norm(p=2, dim=2)
-                + (d_i - d_i_next).norm(p=2, dim=2)
-                - (d_i_pre - d_i_next).norm(p=2, dim=2)
+                edge_lengths(pre, first_row)
+                + edge_lengths(first_row, post)
+                - edge_lengths(pre, post)
             )[:, 1:]
             probs_removal = (
                 cost_[:, : graph_size_plus1 // 2] + cost_[:, graph_size_plus1 // 2 :]
@@ -640,15 +808,39 @@ class NNSDecoder(nn.Module):
         ############# action2
         pos_pickup = (1 + action_removal).view(-1)
         pos_delivery = pos_pickup + half_pos
-        mask_table = (
-            problem.get_swap_mask(action_removal + 1, visit_index, top2)
-            .expand(batch_size, graph_size_plus1, graph_size_plus1)
-            .cpu()
-        )
+        mask_table = problem.get_swap_mask(
+            action_removal + 1, visit_index, top2
+        ).expand(batch_size, graph_size_plus1, graph_size_plus1)
+        if TYPE_REINSERTION == 'NNS' and self.sparse_reinsertion:
+            # only the feasible cells are scored and sampled from
+            pair_index, selected_log_ll_action2, entropy = self._sparse_reinsertion(
+                h_hat,
+                pos_pickup,
+                pos_delivery,
+                solution.post,
+                mask_table,
+                fixed_action,
+                require_entropy,
+            )
+            if fixed_action is not None:
+                action = fixed_action
+            else:
+                action = torch.cat(
+                    (
+                        action_removal.view(batch_size, -1),
+                        pair_index // graph_size_plus1,
+                        pair_index % graph_size_plus1,
+                    ),
+                    -1,
+                )  # batch_size, 3
+            return action, selected_log_ll_action1 + selected_log_ll_action2, entropy
+
         if TYPE_REINSERTION == 'NNS':
             action_reinsertion_table = (
                 torch.tanh(
-                    self.compater_reinsertion(h_hat, pos_pickup, pos_delivery, solution)
+                    self.compater_reinsertion(
+                        h_hat, pos_pickup, pos_delivery, solution.post
+                    )
                 )
                 * self.v_range
             )
@@ -660,44 +852,36 @@ class NNSDecoder(nn.Module):
             # epi-greedy
             pos_pickup = 1 + action_removal
             pos_delivery = pos_pickup + half_pos
-            rec_new = solution.clone()
-            argsort = rec_new.argsort()
-            pre_pairfirst = argsort.gather(1, pos_pickup)
-            post_pairfirst = rec_new.gather(1, pos_pickup)
-            rec_new.scatter_(1, pre_pairfirst, post_pairfirst)
-            rec_new.scatter_(1, pos_pickup, pos_pickup)
-            argsort = rec_new.argsort()
-            pre_pairsecond = argsort.gather(1, pos_delivery)
-            post_pairsecond = rec_new.gather(1, pos_delivery)
-            rec_new.scatter_(1, pre_pairsecond, post_pairsecond)
+            solution_new = solution.clone()
+            PDP._remove_node(solution_new, pos_pickup)
+            PDP._remove_node(solution_new, pos_delivery)
+            rec_new = solution_new.post
             # perform calc on new rec_new
             first_row = (
-                torch.arange(graph_size_plus1, device=solution.device)
+                torch.arange(graph_size_plus1, device=x_in.device)
                 .long()
                 .unsqueeze(0)
                 .expand(batch_size, graph_size_plus1)
             )
-            d_i = x_in.gather(
-                1, first_row.unsqueeze(-1).expand(batch_size, graph_size_plus1, 2)
-            )
-            d_i_next = x_in.gather(
-                1, rec_new.long().unsqueeze(-1).expand(batch_size, graph_size_plus1, 2)
-            )
-            d_pick = x_in.gather(
-                1, pos_pickup.unsqueeze(1).expand(batch_size, graph_size_plus1, 2)
-            )
-            d_deli = x_in.gather(
-                1, pos_delivery.unsqueeze(1).expand(batch_size, graph_size_plus1, 2)
+            edge_lengths = partial(
+                PDP._get_edge_lengths,
+                x_in,
+                distances=distances,
+                distance_rows=distance_rows,
             )
+            rec_new = rec_new.long()
+            pick = pos_pickup.expand(batch_size, graph_size_plus1)
+            deli = pos_delivery.expand(batch_size, graph_size_plus1)
+            length_i_next = edge_lengths(first_row, rec_new)
             cost_insert_p = (
-                (d_pick - d_i).norm(p=2, dim=2)
-                + (d_pick - d_i_next).norm(p=2, dim=2)
-                - (d_i - d_i_next).norm(p=2, dim=2)
+                edge_lengths(pick, first_row)
+                + edge_lengths(pick, rec_new)
+                - length_i_next
             )
             cost_insert_d = (
-                (d_deli - d_i).norm(p=2, dim=2)
-                + (d_deli - d_i_next).norm(p=2, dim=2)
-                - (d_i - d_i_next).norm(p=2, dim=2)
+                edge_lengths(deli, first_row)
+                + edge_lengths(deli, rec_new)
+                - length_i_next
             )
             action_reinsertion_table = -(
                 cost_insert_p.view(batch_size, graph_size_plus1, 1)
@@ -706,7 +890,7 @@ class NNSDecoder(nn.Module):
             action_reinsertion_table_random = torch.ones(
                 batch_size, graph_size_plus1, graph_size_plus1
             ).to(h_wave.device)
-            action_reinsertion_table_random[mask_table] = -1e20
+            action_reinsertion_table_random.masked_fill_(mask_table, -1e20)
             action_reinsertion_table_random = action_reinsertion_table_random.view(
                 batch_size, -1
             )
@@ -716,7 +900,7 @@ class NNSDecoder(nn.Module):
         else:
             assert False
 
-        action_reinsertion_table[mask_table] = -1e20
+        action_reinsertion_table.masked_fill_(mask_table, -1e20)
 
         del visit_index, mask_table
         # reshape action_reinsertion_table
@@ -1044,69 +1228,40 @@ class EmbeddingNet(nn.Module):
         return pattern  # (seq_length, embedding_dim)
 
     def _position_embedding(
-        self, solution: torch.Tensor, embedding_dim: int, calc_stacks: bool
+        self,
+        solution: torch.Tensor,
+        embedding_dim: int,
+        calc_stacks: bool,
+        visit_index: Optional[torch.Tensor] = None,
+        top2: Optional[torch.Tensor] = None,
     ) -> Tuple[torch.Tensor, torch.Tensor, Optional[torch.Tensor]]:
-        batch_size, seq_length = solution.size()
-        half_size = seq_length // 2
-
-        # expand for every batch
-        position_emb_new = (
-            self.pattern.expand(batch_size, seq_length, embedding_dim)
-            .clone()
-            .to(solution.device)
-        )
+        # get index according to the solutions, unless already known
+        if visit_index is None:
+            visit_index = PDP.get_visit_index(solution)  # (batch_size, seq_length)
 
-        # get index according to the solutions
-        visit_index = torch.zeros((batch_size, seq_length), device=solution.device)
-
-        pre = torch.zeros((batch_size), device=solution.device).long()
-
-        arange = torch.arange(batch_size)
-        if calc_stacks:
-            stacks = (
-                torch.zeros(batch_size, half_size + 1, device=solution.device) - 0.01
-            )  # fix bug: topk is not stable sorting
-            top2 = torch.zeros(batch_size, seq_length, 2, device=solution.device).long()
-            stacks[arange, pre] = 0  # fix bug: topk is not stable sorting
-
-        for i in range(seq_length):
-            current_nodes = solution[arange, pre]  # (batch_size,)
-            visit_index[arange, current_nodes] = i + 1
-            pre = current_nodes
-
-            if calc_stacks:
-                index1 = (current_nodes <= half_size) & (current_nodes > 0)
-                index2 = (current_nodes > half_size) & (current_nodes > 0)
-                if index1.any():
-                    stacks[index1, current_nodes[index1]] = i + 1
-                if index2.any():
-                    stacks[
-                        index2, current_nodes[index2] - half_size
-                    ] = -0.01  # fix bug: topk is not stable sorting
-                top2[arange, current_nodes] = stacks.topk(2)[1]
-                # stack top after visit
-                # node+, (current_stack_top, last_stack_top_or_0)
-                # node-, (current_stack_top, last_stack_top_or_0) or (0, 1_meaningless)
-
-        index = (
-            (visit_index % seq_length)
-            .long()
-            .unsqueeze(-1)
-            .expand(batch_size, seq_length, embedding_dim)
-        )
+        # stack top after visit
+        # node+, (current_stack_top, last_stack_top_or_0)
+        # node-, (current_stack_top, last_stack_top_or_0) or (0, 1_meaningless)
+        if not calc_stacks:
+            top2 = None
+        elif top2 is None:
+            top2 = PDP.get_stack_top2(visit_index)
 
-        return (
-            torch.gather(position_emb_new, 1, index),
-            (visit_index % seq_length).long(),
-            top2 if calc_stacks else None,
-        )
+        position_emb_new = self.pattern.to(solution.device)[visit_index]
+
+        return position_emb_new, visit_index, top2
 
     __call__: Callable[
         ..., Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]
     ]
 
     def forward(
-        self, x: torch.Tensor, solution: Optional[torch.Tensor], calc_stacks: bool
+        self,
+        x: torch.Tensor,
+        solution: Optional[torch.Tensor],
+        calc_stacks: bool,
+        visit_index: Optional[torch.Tensor] = None,
+        top2: Optional[torch.Tensor] = None,
     ):
         if self.feature_embedder is None:
             fea_emb = None
@@ -1117,7 +1272,7 @@ class EmbeddingNet(nn.Module):
             return fea_emb, None, None, None
 
         pos_emb, visit_index, top2 = self._position_embedding(
-            solution, self.embedding_dim, calc_stacks
+            solution, self.embedding_dim, calc_stacks, visit_index, top2
         )
         return fea_emb, pos_emb, visit_index, top2
 
@@ -1187,7 +1342,15 @@ class ConstructDecoder(nn.Module):
             1, input_dim, input_dim, None, input_dim
         )
 
-    __call__: Callable[..., Tuple[torch.Tensor, torch.Tensor]]
+    def precompute(
+        self, h_fea: torch.Tensor
+    ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        # h_fea is fixed during construction, so are the keys and values
+        K_glimpse, V_glimpse = self.first_MHA.precompute_kv(h_fea, h_fea)
+        K_logit, _ = self.second_SHA_score.precompute_kv(h_fea)
+        return K_glimpse, V_glimpse, K_logit  # type: ignore
+
+    __call__: Callable[..., Tuple[torch.Tensor, torch.Tensor, torch.Tensor]]
 
     def forward(
         self,
@@ -1199,51 +1362,72 @@ class ConstructDecoder(nn.Module):
         stack: torch.Tensor,
         direct_fixed_sol: Optional[torch.Tensor],
         temperature: float,
-    ) -> Tuple[torch.Tensor, torch.Tensor]:
-        batch_size, graph_size_plus1, _ = h_fea.size()
+        cur_node: torch.Tensor,  # (batch_size*n_samples,), the last visited node
+        cache: Optional[Tuple[torch.Tensor, torch.Tensor, torch.Tensor]] = None,
+    ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        # no host sync and fixed shapes in every step
+        # the n_samples rows of an instance share its h_fea, they are the queries
+        batch_size, graph_size_plus1, input_dim = h_fea.size()
         half_size = graph_size_plus1 // 2
-        arange = torch.arange(batch_size)
+        n_samples = cur_node.size(0) // batch_size
+        n_rows = batch_size * n_samples
 
-        last_step = torch.argwhere(part_sol == 0)[:, 1]
-        context_emb = torch.cat((h_mean, h_fea[arange, last_step, :]), -1).unsqueeze(1)
+        if cache is None:
+            cache = self.precompute(h_fea)
+        K_glimpse, V_glimpse, K_logit = cache
 
-        hc = self.first_MHA(context_emb, h_fea, h_fea)
+        h_cur = h_fea.gather(
+            1,
+            cur_node.view(batch_size, n_samples, 1).expand(
+                batch_size, n_samples, input_dim
+            ),
+        )  # (batch_size, n_samples, input_dim)
+        context_emb = torch.cat((h_mean.unsqueeze(1).expand_as(h_cur), h_cur), -1)
+
+        hc = self.first_MHA.forward_with_kv(context_emb, K_glimpse, V_glimpse)
         uc = (
-            torch.tanh(self.second_SHA_score(hc, h_fea, with_norm=True)) * self.C
-        ).view(batch_size, -1)
+            torch.tanh(
+                self.second_SHA_score.forward_with_kv(hc, K_logit, with_norm=True)
+            )
+            * self.C
+        ).view(n_rows, -1)
         uc /= temperature
 
         mask = self._get_mask(part_sol, init_sol, stack)
-        uc[mask] = -1e20
+        uc = uc.masked_fill(mask, -1e20)
 
         prob = F.softmax(uc, dim=-1)
         log_p = F.log_softmax(uc, dim=-1)
 
         if direct_fixed_sol is None:
             if self.type_select == 'greedy':
-                next_node = prob.max(1)[1]  # (batch_size,)
+                next_node = prob.max(1)[1]  # (n_rows,)
             elif self.type_select == 'sample':
-                next_node = prob.multinomial(1).view(
-                    -1
-                )  # (batch_size, 1) -> (batch_size,)
+                next_node = prob.multinomial(1).view(-1)  # (n_rows, 1) -> (n_rows,)
             else:
                 raise NotImplementedError
         else:
             next_node = direct_fixed_sol[:, step + 1]
 
-        part_sol[arange, last_step] = next_node
-        part_sol[arange, next_node] = 0
+        next_node = next_node.view(n_rows, 1)
+        part_sol.scatter_(1, cur_node.view(n_rows, 1), next_node)
+        part_sol.scatter_(1, next_node, 0)
 
-        sel_log_p = log_p[arange, next_node]
+        sel_log_p = log_p.gather(1, next_node).view(-1)
 
-        index_in = (next_node <= half_size) & (next_node > 0)
-        index_out = (next_node > half_size) & (next_node > 0)
-        if index_in.any():
-            stack[index_in, next_node[index_in]] = step + 1
-        if index_out.any():
-            stack[index_out, next_node[index_out] - half_size] = -1
+        # pickup: stack[pickup] = step + 1, delivery: stack[pickup] = -1
+        is_delivery = next_node > half_size
+        stack.scatter_(
+            1,
+            torch.where(is_delivery, next_node - half_size, next_node),
+            torch.where(
+                is_delivery,
+                torch.full_like(stack[:, :1], -1),
+                torch.full_like(stack[:, :1], step + 1),
+            ).masked_fill(next_node == 0, 0),
+        )
 
-        return part_sol, sel_log_p
+        return part_sol, sel_log_p, next_node.view(-1)
 
     def _get_mask(
         self,
@@ -1251,22 +1435,20 @@ class ConstructDecoder(nn.Module):
         init_sol: torch.Tensor,
         stack: torch.Tensor,
     ) -> torch.Tensor:
-        arange = torch.arange(stack.size(0)).to(stack.device)
         half_size = stack.size(1) - 1
 
         mask = (part_sol == 0) | (part_sol != init_sol)
 
         if not self.stack_is_lifo:
-            wait_to_pick = torch.argwhere(stack < 0)
-            wait_to_pick[:, 1] += half_size
-            mask[wait_to_pick[:, 0], wait_to_pick[:, 1]] = True
+            # deliveries waiting for their pickups
+            mask_delivery = mask[:, half_size + 1 :] | (stack[:, 1:] < 0)
         else:
-            stack_top = stack.max(1)[1]
-            stack_top[stack_top != 0] += half_size
-            mask[:, half_size + 1 :] = True
-            mask[arange[stack_top != 0], stack_top[stack_top != 0]] = False
+            # only the delivery of the stack top
+            stack_top = stack.max(1)[1].unsqueeze(1)
+            pickups = torch.arange(1, half_size + 1, device=stack.device)
+            mask_delivery = pickups != stack_top
 
-        return mask
+        return torch.cat((mask[:, : half_size + 1], mask_delivery), 1)
 
 
 class SepEmbedding(nn.Module):
@@ -24,6 +24,7 @@ class Option(argparse.Namespace):
     inference_sample_size: int
     inference_sample_batch: int
     inference_temperature: List[float]
+    shared_encoding_sample: bool
 
     temperature_init: float
     temperature_decay: float
@@ -60,6 +61,8 @@ class Option(argparse.Namespace):
     problem: str
     graph_size: int
     init_val_method: str
+    cost_resync_steps: int
+    distance_dtype: str
     no_cuda: bool
     no_tb: bool
     no_saving: bool
@@ -76,6 +79,8 @@ class Option(argparse.Namespace):
     ff_hidden_dim: int
     n_encode_layers: int
     normalization: str
+    reinsertion_chunk_size: int
+    sparse_reinsertion: bool
 
     # Training parameters
     RL_agent: str
@@ -92,6 +97,7 @@ class Option(argparse.Namespace):
     lr_critic: float
     lr_decay: float
     max_grad_norm: float
+    ppo_eval_chunk: int
 
     # Inference and validation parameters
     T_max: int
@@ -100,6 +106,15 @@ class Option(argparse.Namespace):
     val_batch_size: int
     val_dataset: Optional[str]
     val_m: int
+    val_m_augments: str
+    val_m_rotations: bool
+    val_m_share_steps: int
+    history_mode: str
+    history_steps: List[int]
+    stagnation_steps: int
+    time_budget: float
+    time_budget_amortized: bool
+    time_points: int
 
     # resume and load models
     load_path: Optional[str]
@@ -198,6 +213,11 @@ def get_options(args: Optional[List[str]] = None) -> Option:
         default=[1],
         help='control the diversity of the sampled tours when inference',
     )
+    parser.add_argument(
+        '--shared_encoding_sample',
+        action='store_true',
+        help='encode each instance once and decode all its initial samples against it',
+    )
     parser.add_argument(
         '--temperature_init',
         type=float,
@@ -330,6 +350,20 @@ def get_options(args: Optional[List[str]] = None) -> Option:
         default='random',
         help='method to generate initial solutions for inference',
     )
+    parser.add_argument(
+        '--cost_resync_steps',
+        type=int,
+        default=100,
+        help='recompute the whole objective every n steps instead of the incremental '
+        'update to bound float drift, set <=0 to off',
+    )
+    parser.add_argument(
+        '--distance_dtype',
+        default='none',
+        choices=('none', 'float32', 'float16'),
+        help='precompute the distance matrix of every instance at load in this dtype, '
+        'edge lengths are then looked up instead of computed from coordinates',
+    )
     parser.add_argument('--no_cuda', action='store_true', help='disable GPUs')
     parser.add_argument(
         '--no_tb', action='store_true', help='disable Tensorboard logging'
@@ -382,6 +416,18 @@ def get_options(args: Optional[List[str]] = None) -> Option:
         default='layer',
         help="normalization type, 'layer' (default) or 'batch'",
     )
+    parser.add_argument(
+        '--reinsertion_chunk_size',
+        type=int,
+        default=0,
+        help='score the reinsertion cells this many pickup positions at a time '
+        'to save memory, set 0 to score all at once',
+    )
+    parser.add_argument(
+        '--sparse_reinsertion',
+        action='store_true',
+        help='only score and sample the feasible reinsertion cells',
+    )
 
     # Training parameters
     parser.add_argument(
@@ -443,6 +489,14 @@ def get_options(args: Optional[List[str]] = None) -> Option:
         default=-1,  # variable default
         help='maximum L2 norm for gradient clipping',
     )
+    parser.add_argument(
+        '--ppo_eval_chunk',
+        type=int,
+        default=1,
+        help='number of stored steps re-evaluated in one actor/critic pass '
+        'during the PPO update, set 0 to evaluate all steps at once, '
+        'only 1 with batch normalization',
+    )
 
     # Inference and validation parameters
     parser.add_argument(
@@ -472,6 +526,69 @@ def get_options(args: Optional[List[str]] = None) -> Option:
     parser.add_argument(
         '--val_m', type=int, default=1, help='number of data augments in Algorithm 2'
     )
+    parser.add_argument(
+        '--val_m_augments',
+        default='random',
+        choices=('random', 'distinct'),
+        help='draw one of the 8 symmetries of the square for each val_m augment, or '
+        'give them the symmetries in turn with the first keeping the instance',
+    )
+    parser.add_argument(
+        '--val_m_rotations',
+        action='store_true',
+        help='with distinct augments, turn each later round of 8 by an angle in '
+        '(0, 90) degrees instead of repeating the symmetries, the model sees these '
+        'views shrunk back into the unit square (or zoomed with --zoom), costs are '
+        'measured unscaled',
+    )
+    parser.add_argument(
+        '--val_m_share_steps',
+        type=int,
+        default=0,
+        help='every this many steps, and after construction, all val_m augments of '
+        'an instance go on from its best solution, set <=0 to off',
+    )
+    parser.add_argument(
+        '--history_mode',
+        default='full',
+        choices=('full', 'checkpoint', 'summary'),
+        help='keep the cost history of every step, of --history_steps, or none',
+    )
+    parser.add_argument(
+        '--history_steps',
+        type=int,
+        nargs='*',
+        default=[],
+        help='steps to keep in checkpoint mode, defaults to the ones logged',
+    )
+    parser.add_argument(
+        '--stagnation_steps',
+        type=int,
+        default=0,
+        help='stop searching an instance once its best cost has not improved for '
+        'this many steps, set <=0 to off',
+    )
+    parser.add_argument(
+        '--time_budget',
+        type=float,
+        default=0,
+        help='seconds of search per batch, replaces T_max as the stopping rule, '
+        'the instances of a batch are searched together so this is also the '
+        'deadline of each of them, set <=0 to off',
+    )
+    parser.add_argument(
+        '--time_budget_amortized',
+        action='store_true',
+        help='the time budget is an amortized throughput budget per instance, a '
+        'batch searches for it times its size, not a latency deadline',
+    )
+    parser.add_argument(
+        '--time_points',
+        type=int,
+        default=10,
+        help='number of evenly spaced points of the time budget to record the best '
+        'cost at',
+    )
 
     # resume and load models
     parser.add_argument(
@@ -609,6 +726,14 @@ def get_options(args: Optional[List[str]] = None) -> Option:
 
     # assert opts.val_m <= opts.graph_size // 2
     assert opts.epoch_size % opts.batch_size == 0
+    # stacked steps would share the BatchNorm statistics, unlike during the rollout
+    assert (
+        opts.ppo_eval_chunk == 1 or opts.normalization != 'batch'
+    ), '--ppo_eval_chunk must be 1 with --normalization batch'
+    # the symmetries fill the first round of 8, only later rounds are turned
+    assert not opts.val_m_rotations or (
+        opts.val_m_augments == 'distinct' and opts.val_m > 8
+    ), '--val_m_rotations needs --val_m_augments distinct and --val_m > 8'
     if opts.distributed:
         assert opts.batch_size % opts.world_size == 0
 
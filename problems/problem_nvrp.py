@@ -1,4 +1,4 @@
-from typing import Dict
+from typing import Dict, Optional
 import torch
 
 from .problem_pdp import PDP
@@ -24,15 +24,8 @@ class NVRP(PDP):
         visit_index: torch.Tensor,
         top2: torch.Tensor,
     ) -> torch.Tensor:
-        visited_order_map = PDP._get_visit_order_map(visit_index)
-        batch_size, graph_size_plus1, _ = visited_order_map.size()
-
-        mask = visited_order_map.clone()  # true means unavailable
-        arange = torch.arange(batch_size)
-        mask[arange, selected_node.view(-1)] = True
-        mask[arange, selected_node.view(-1) + graph_size_plus1 // 2] = True
-        mask[arange, :, selected_node.view(-1)] = True
-        mask[arange, :, selected_node.view(-1) + graph_size_plus1 // 2] = True
+        # true means unavailable, including the rows and columns of the selected pair
+        mask = PDP._get_visit_order_map(visit_index, selected_node)
 
         return mask
 
@@ -73,43 +66,11 @@ class NVRP(PDP):
                 return solution
 
             elif methods == 'greedy':
-                candidates = torch.ones(batch_size, self.size + 1).bool()
-                candidates[:, half_size + 1 :] = 0
-                solution = torch.zeros(batch_size, self.size + 1).long()
-                selected_node = torch.zeros(batch_size, 1).long()
-                candidates.scatter_(1, selected_node, 0)
-
-                for _ in range(self.size):
-                    d1 = (
-                        batch['coordinates']
-                        .cpu()
-                        .gather(
-                            1,
-                            selected_node.unsqueeze(-1).expand(
-                                batch_size, self.size + 1, 2
-                            ),
-                        )
-                    )
-                    d2 = batch['coordinates'].cpu()  # (batch_size, graph_size+1, 2)
-
-                    dists = (d1 - d2).norm(p=2, dim=2)  # (batch_size, graph_size+1)
-                    dists[~candidates] = 1e6
-                    next_selected_node = dists.min(-1)[1].view(-1, 1)
-
-                    add_index = (next_selected_node <= half_size).view(-1)
-                    pairing = (
-                        next_selected_node[next_selected_node <= half_size].view(-1, 1)
-                        + half_size
-                    )
-                    candidates[add_index] = candidates[add_index].scatter_(
-                        1, pairing, 1
-                    )
-
-                    solution.scatter_(1, selected_node, next_selected_node)
-                    candidates.scatter_(1, next_selected_node, 0)
-                    selected_node = next_selected_node
-
-                return solution
+                return self._get_greedy_solution(
+                    batch['coordinates'],
+                    batch.get('distances'),
+                    batch.get('distance_rows'),
+                )
 
             else:
                 raise NotImplementedError()
@@ -118,6 +79,55 @@ class NVRP(PDP):
             get_solution(self.init_val_method).expand(batch_size, self.size + 1).clone()
         )
 
+    def _get_greedy_solution(
+        self,
+        coordinates: torch.Tensor,
+        distances: Optional[torch.Tensor] = None,
+        distance_rows: Optional[torch.Tensor] = None,
+    ) -> torch.Tensor:
+        # nearest feasible neighbour, on the device of coordinates and without syncs
+        batch_size = coordinates.size(0)
+        half_size = self.size // 2
+        device = coordinates.device
+
+        if distances is None:
+            dist_mat = PDP._get_distance_matrix(coordinates)  # once per batch
+            distance_rows = None
+        else:
+            dist_mat = distances  # the table of every row, upcast per lookup
+        if distance_rows is None:
+            distance_rows = torch.arange(batch_size, device=device)
+
+        candidates = torch.zeros(
+            batch_size, self.size + 1, dtype=torch.bool, device=device
+        )
+        candidates[:, 1 : half_size + 1] = True  # the pickups, not the depot
+        solution = torch.zeros(
+            batch_size, self.size + 1, dtype=torch.long, device=device
+        )
+        selected_node = torch.zeros(batch_size, 1, dtype=torch.long, device=device)
+
+        for _ in range(self.size):
+            dists = dist_mat[
+                distance_rows, selected_node.view(-1)
+            ].float()  # (batch_size, graph_size+1)
+            dists = dists.masked_fill(~candidates, 1e6)
+            next_selected_node = dists.min(-1)[1].view(-1, 1)
+
+            # a picked up pair opens its delivery, a delivery is closed right after
+            pairing = torch.where(
+                next_selected_node <= half_size,
+                next_selected_node + half_size,
+                next_selected_node,
+            )
+            candidates.scatter_(1, pairing, True)
+
+            solution.scatter_(1, selected_node, next_selected_node)
+            candidates.scatter_(1, next_selected_node, False)
+            selected_node = next_selected_node
+
+        return solution
+
     def _check_feasibility(self, solution: torch.Tensor) -> None:
         assert (
             (torch.arange(self.size + 1, out=solution.new()))
@@ -1,4 +1,4 @@
-from typing import Dict
+from typing import Dict, Optional
 import torch
 
 from .problem_pdp import PDP
@@ -24,19 +24,15 @@ class NVTA(PDP):
         visit_index: torch.Tensor,
         top2: torch.Tensor,
     ) -> torch.Tensor:
-        visited_order_map = PDP._get_visit_order_map(visit_index)
-        batch_size, graph_size_plus1, _ = visited_order_map.size()
-        arange = torch.arange(batch_size)
-        top = torch.where(top2[:, :, 0] == selected_node, top2[:, :, 1], top2[:, :, 0])
-        mask_pd = top.view(-1, graph_size_plus1, 1) != top.view(-1, 1, graph_size_plus1)
+        top = torch.where(
+            top2[:, :, 0] == selected_node.view(-1, 1), top2[:, :, 1], top2[:, :, 0]
+        )
 
-        mask = visited_order_map.clone()  # true means unavailable
-        mask[arange, selected_node.view(-1)] = True
-        mask[arange, selected_node.view(-1) + graph_size_plus1 // 2] = True
-        mask[arange, :, selected_node.view(-1)] = True
-        mask[arange, :, selected_node.view(-1) + graph_size_plus1 // 2] = True
+        # true means unavailable, including the rows and columns of the selected pair
+        mask = PDP._get_visit_order_map(visit_index, selected_node)
+        mask |= top.unsqueeze(2) != top.unsqueeze(1)
 
-        return mask | mask_pd
+        return mask
 
     def get_initial_solutions(self, batch: Dict[str, torch.Tensor]) -> torch.Tensor:
 
@@ -80,61 +76,11 @@ class NVTA(PDP):
                 return solution
 
             elif methods == 'greedy':
-
-                candidates = torch.ones(batch_size, self.size + 1).bool()
-                candidates[:, half_size + 1 :] = 0
-                solution = torch.zeros(batch_size, self.size + 1).long()
-                selected_node = torch.zeros(batch_size, 1).long()
-                candidates.scatter_(1, selected_node, 0)
-                stacks = torch.zeros(batch_size, half_size + 1) - 0.01
-                stacks[:, 0] = 0  # fix bug: max is not stable sorting
-                for i in range(self.size):
-
-                    index1 = (selected_node <= half_size) & (selected_node > 0)
-                    if index1.any():
-                        stacks[index1.view(-1), selected_node[index1]] = i + 1
-                    top = stacks.max(-1)[1]
-
-                    d1 = (
-                        batch['coordinates']
-                        .cpu()
-                        .gather(
-                            1,
-                            selected_node.unsqueeze(-1).expand(
-                                batch_size, self.size + 1, 2
-                            ),
-                        )
-                    )
-                    d2 = batch['coordinates'].cpu()
-
-                    dists = (d1 - d2).norm(p=2, dim=2)
-                    dists[~candidates] = 1e6
-
-                    dists[:, self.size // 2 + 1 :] += 1e3  # mask all delivery
-                    dists[top > 0, top[top > 0] + half_size] -= 1e3
-
-                    next_selected_node = dists.min(-1)[1].view(-1, 1)
-
-                    index2 = (next_selected_node > half_size) & (next_selected_node > 0)
-                    if index2.any():
-                        stacks[
-                            index2.view(-1), next_selected_node[index2] - half_size
-                        ] = -0.01
-
-                    add_index = (next_selected_node <= half_size).view(-1)
-                    pairing = (
-                        next_selected_node[next_selected_node <= half_size].view(-1, 1)
-                        + half_size
-                    )
-                    candidates[add_index] = candidates[add_index].scatter_(
-                        1, pairing, 1
-                    )
-
-                    solution.scatter_(1, selected_node, next_selected_node)
-                    candidates.scatter_(1, next_selected_node, 0)
-                    selected_node = next_selected_node
-
-                return solution
+                return self._get_greedy_solution(
+                    batch['coordinates'],
+                    batch.get('distances'),
+                    batch.get('distance_rows'),
+                )
 
             else:
                 raise NotImplementedError()
@@ -143,6 +89,82 @@ class NVTA(PDP):
             get_solution(self.init_val_method).expand(batch_size, self.size + 1).clone()
         )
 
+    def _get_greedy_solution(
+        self,
+        coordinates: torch.Tensor,
+        distances: Optional[torch.Tensor] = None,
+        distance_rows: Optional[torch.Tensor] = None,
+    ) -> torch.Tensor:
+        # nearest feasible neighbour, on the device of coordinates and without syncs
+        batch_size = coordinates.size(0)
+        half_size = self.size // 2
+        device = coordinates.device
+
+        if distances is None:
+            dist_mat = PDP._get_distance_matrix(coordinates)  # once per batch
+            distance_rows = None
+        else:
+            dist_mat = distances  # the table of every row, upcast per lookup
+        if distance_rows is None:
+            distance_rows = torch.arange(batch_size, device=device)
+
+        candidates = torch.zeros(
+            batch_size, self.size + 1, dtype=torch.bool, device=device
+        )
+        candidates[:, 1 : half_size + 1] = True  # the pickups, not the depot
+        solution = torch.zeros(
+            batch_size, self.size + 1, dtype=torch.long, device=device
+        )
+        selected_node = torch.zeros(batch_size, 1, dtype=torch.long, device=device)
+        stacks = torch.zeros(batch_size, half_size + 1, device=device) - 0.01
+        stacks[:, 0] = 0  # fix bug: max is not stable sorting
+        delivery_penalty = torch.zeros(self.size + 1, device=device)
+        delivery_penalty[half_size + 1 :] = 1e3  # mask all delivery
+
+        for i in range(self.size):
+            # pickups are pushed with their step, column 0 is written with 0
+            is_pickup = (selected_node <= half_size) & (selected_node > 0)
+            stacks.scatter_(
+                1,
+                selected_node * is_pickup,
+                is_pickup.to(stacks.dtype) * (i + 1),
+            )
+            top = stacks.max(-1)[1].view(-1, 1)
+
+            dists = dist_mat[
+                distance_rows, selected_node.view(-1)
+            ].float()  # (batch_size, graph_size+1)
+            dists = dists.masked_fill(~candidates, 1e6)
+
+            # only the delivery of the stack top is unmasked, top 0 adds 0 to a pickup
+            dists = dists + delivery_penalty
+            dists = dists.scatter_add(
+                1, top + half_size, (top > 0).to(dists.dtype) * -1e3
+            )
+
+            next_selected_node = dists.min(-1)[1].view(-1, 1)
+
+            # a delivery pops its pickup off the stack
+            is_delivery = next_selected_node > half_size
+            stacks.scatter_(
+                1,
+                (next_selected_node - half_size) * is_delivery,
+                is_delivery.to(stacks.dtype) * -0.01,
+            )
+
+            pairing = torch.where(
+                next_selected_node <= half_size,
+                next_selected_node + half_size,
+                next_selected_node,
+            )
+            candidates.scatter_(1, pairing, True)
+
+            solution.scatter_(1, selected_node, next_selected_node)
+            candidates.scatter_(1, next_selected_node, False)
+            selected_node = next_selected_node
+
+        return solution
+
     def _check_feasibility(self, solution: torch.Tensor) -> None:
 
         size_p1 = self.size + 1
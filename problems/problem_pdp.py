@@ -1,9 +1,107 @@
-from typing import Dict, Iterable, List, Optional, Tuple
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple, Union
 from abc import ABC, abstractmethod
 import os
+import math
 import pickle
+import numpy as np
 import torch
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, Sampler
+
+
+class SolutionState:
+    def __init__(
+        self,
+        post: torch.Tensor,  # (batch_size, graph_size+1)
+        pre: Optional[torch.Tensor] = None,  # (batch_size, graph_size+1)
+        visit_index: Optional[torch.Tensor] = None,  # (batch_size, graph_size+1)
+        top2: Optional[torch.Tensor] = None,  # (batch_size, graph_size+1, 2)
+    ) -> None:
+        self.post = post  # if post=[2,0,1], means 0->2->1->0.
+        self.pre = post.argsort() if pre is None else pre  # pre=[1,2,0]
+        # derived once by the actor, then carried along by PDP.step
+        self.visit_index = visit_index  # visit_index=[0,2,1]
+        self.top2 = top2  # stack tops after visit, only for LIFO
+
+    def clone(self) -> 'SolutionState':
+        return SolutionState(
+            self.post.clone(),
+            self.pre.clone(),
+            None if self.visit_index is None else self.visit_index.clone(),
+            None if self.top2 is None else self.top2.clone(),
+        )
+
+    def select(self, index: torch.Tensor) -> 'SolutionState':
+        # only the rows in index, e.g. to drop finished instances from the batch
+        return SolutionState(
+            self.post[index],
+            self.pre[index],
+            None if self.visit_index is None else self.visit_index[index],
+            None if self.top2 is None else self.top2[index],
+        )
+
+
+class ActionRemovalRecord:
+    def __init__(
+        self,
+        batch_size: int,
+        half_size: int,
+        length: int,
+        device: Optional[torch.device] = None,
+    ) -> None:
+        # the last `length` removed pairs, as a ring buffer on device
+        self.length = length
+        self.removed = torch.full(
+            (batch_size, length), -1, dtype=torch.long, device=device
+        )  # -1 means nothing removed yet
+        self.counts = torch.zeros(
+            batch_size, half_size, device=device
+        )  # times each pair is in the buffer
+        self.pointer = 0  # slot of the oldest removal
+        self.last3_slots = (
+            torch.arange(-3, 0, device=device) % length
+        )  # slots of the 3 newest removals, kept on device along with pointer
+
+    def push(self, selected_minus1: torch.Tensor) -> None:  # (batch_size,)
+        # in place, the oldest removal is dropped
+        oldest = self.removed[:, self.pointer, None]
+        self.counts.scatter_add_(
+            1, oldest.clamp(min=0), -(oldest >= 0).to(self.counts.dtype)
+        )
+        self.counts.scatter_add_(
+            1,
+            selected_minus1.view(-1, 1),
+            torch.ones_like(self.counts[:, :1]),
+        )
+        self.removed[:, self.pointer] = selected_minus1
+        self.pointer = (self.pointer + 1) % self.length
+        self.last3_slots = (self.last3_slots + 1) % self.length
+
+    def select_(self, index: torch.Tensor) -> None:
+        # in place, only the rows in index are kept
+        self.removed = self.removed[index]
+        self.counts = self.counts[index]
+
+    def last3(self) -> torch.Tensor:
+        return self.removed.index_select(
+            1, self.last3_slots
+        )  # (batch_size, 3), from old to new
+
+    def recent(self) -> torch.Tensor:
+        return ActionRemovalRecord.get_recent(self.last3(), self.counts, self.length)
+
+    @staticmethod
+    def get_recent(
+        last3: torch.Tensor,  # (batch_size, 3)
+        counts: torch.Tensor,  # (batch_size, graph_size/2)
+        length: int,
+    ) -> torch.Tensor:
+        batch_size, half_size = counts.size()
+        one_hot = torch.zeros(
+            batch_size, 3, half_size + 1, device=counts.device
+        ).scatter_(2, last3.long().unsqueeze(-1) + 1, 1)
+        return torch.cat(
+            (one_hot[:, :, 1:], (counts.float() / length).unsqueeze(1)), 1
+        )  # (batch_size, 4, graph_size/2)
 
 
 class PDP(ABC):
@@ -39,58 +137,293 @@ class PDP(ABC):
         return batch['coordinates']
 
     @staticmethod
-    def _get_visit_order_map(visit_index: torch.Tensor) -> torch.Tensor:
+    def _get_visit_order_map(
+        visit_index: torch.Tensor,
+        selected_node: Optional[torch.Tensor] = None,  # (batch_size, 1)
+    ) -> torch.Tensor:
         batch_size, graph_size_plus1 = visit_index.size()
-        return visit_index.view(batch_size, graph_size_plus1, 1) > visit_index.view(
+        row, column = visit_index, visit_index
+        if selected_node is not None:
+            # the selected pair is later than all as row, earlier than all as column
+            nodes = torch.arange(graph_size_plus1, device=visit_index.device)
+            selected_node = selected_node.view(-1, 1)
+            pair = (nodes == selected_node) | (
+                nodes == selected_node + graph_size_plus1 // 2
+            )
+            row = visit_index.masked_fill(pair, graph_size_plus1)
+            column = visit_index.masked_fill(pair, -1)
+        return row.view(batch_size, graph_size_plus1, 1) > column.view(
             batch_size, 1, graph_size_plus1
         )  # row late than column: true
 
+    @staticmethod
+    def _remove_node(
+        solution: SolutionState, node: torch.Tensor  # (batch_size, 1)
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        # in place, let: node -> node afterwards
+        pre_node = solution.pre.gather(1, node)
+        post_node = solution.post.gather(1, node)
+
+        solution.post.scatter_(1, pre_node, post_node)
+        solution.pre.scatter_(1, post_node, pre_node)
+        solution.post.scatter_(1, node, node)
+        solution.pre.scatter_(1, node, node)
+
+        return pre_node, post_node
+
+    @staticmethod
+    def _insert_node(
+        solution: SolutionState,
+        node: torch.Tensor,  # (batch_size, 1)
+        after: torch.Tensor,  # (batch_size, 1)
+    ) -> torch.Tensor:
+        # in place, after -> node -> post_after
+        post_after = solution.post.gather(1, after)
+
+        solution.post.scatter_(1, after, node)
+        solution.post.scatter_(1, node, post_after)
+        solution.pre.scatter_(1, post_after, node)
+        solution.pre.scatter_(1, node, after)
+
+        return post_after
+
+    @staticmethod
+    def _remove_visit(
+        visit_index: torch.Tensor, node: torch.Tensor  # (batch_size, 1)
+    ) -> None:
+        # in place, visits after node move forward by one
+        visit_index -= (visit_index > visit_index.gather(1, node)).long()
+
+    @staticmethod
+    def _insert_visit(
+        visit_index: torch.Tensor,
+        node: torch.Tensor,  # (batch_size, 1)
+        after: torch.Tensor,  # (batch_size, 1)
+    ) -> None:
+        # in place, node is visited right after `after`, later visits move back by one
+        position = visit_index.gather(1, after) + 1
+        visit_index += (visit_index >= position).long()
+        visit_index.scatter_(1, node, position)
+
+    @staticmethod
+    def _move_stack_top2(
+        top2: torch.Tensor,  # (batch_size, graph_size+1, 2), before the move
+        visit_index_old: torch.Tensor,
+        visit_index: torch.Tensor,
+        pair_first: torch.Tensor,  # (batch_size, 1)
+        first: torch.Tensor,  # (batch_size, 1), visited right before pair_first
+    ) -> torch.Tensor:
+        # LIFO keeps the stacks nested, so moving a pair only takes pair_first off
+        # the stacks of its old span and puts it on those of its new one, right above
+        # the top at first, the third of a stack is the second of its second
+        seq_length = visit_index.size(1)
+        pair_second = pair_first + seq_length // 2
+
+        def is_open(visit_index: torch.Tensor) -> torch.Tensor:
+            visit_time = visit_index.clone()
+            visit_time[:, 0] = seq_length  # depot is visited at last
+            return (visit_time >= visit_index.gather(1, pair_first)) & (
+                visit_time < visit_index.gather(1, pair_second)
+            )
+
+        top, second = top2[:, :, 0], top2[:, :, 1]
+
+        # remove pair_first from the stacks of its old span
+        was_open = is_open(visit_index_old)
+        was_top = was_open & (top == pair_first)
+        was_second = was_open & (second == pair_first)
+        top, second = (
+            torch.where(was_top, second, top),
+            torch.where(
+                was_top,
+                second.gather(1, second),
+                torch.where(was_second, second.gather(1, pair_first), second),
+            ),
+        )
+
+        # put it right above the top at first on the stacks of its new span
+        parent = top.gather(1, first)
+        now_open = is_open(visit_index)
+        on_top = now_open & (top == parent)
+        under_top = now_open & ~on_top & (second == parent)
+        top2 = torch.stack(
+            (
+                torch.where(on_top, pair_first, top),
+                torch.where(
+                    on_top, parent, torch.where(under_top, pair_first, second)
+                ),
+            ),
+            2,
+        )
+
+        # the stack after pair_second is the one after first
+        top2.scatter_(
+            1,
+            pair_first.unsqueeze(-1).expand(-1, 1, 2),
+            torch.cat((pair_first, parent), 1).unsqueeze(1),
+        )
+        top2.scatter_(
+            1,
+            pair_second.unsqueeze(-1).expand(-1, 1, 2),
+            torch.stack((parent, second.gather(1, first)), 2),
+        )
+        return top2
+
     @staticmethod
     def _insert_star(
-        solution: torch.Tensor,  # (batch_size, graph_size+1)
+        solution: SolutionState,
         pair_first: torch.Tensor,  # (batch_size, 1)
         first: torch.Tensor,  # (batch_size, 1)
         second: torch.Tensor,  # (batch_size, 1)
-    ) -> torch.Tensor:
-        solution = solution.clone()  # if solution=[2,0,1], means 0->2->1->0.
-        graph_size_plus1 = solution.size(1)
+    ) -> Tuple[SolutionState, torch.Tensor]:
+        solution = solution.clone()
+        graph_size_plus1 = solution.post.size(1)
+        pair_second = pair_first + graph_size_plus1 // 2
 
         assert (
             (pair_first != first).all()
             and (pair_first != second).all()
-            and ((pair_first + graph_size_plus1 // 2) != first).all()
-            and ((pair_first + graph_size_plus1 // 2) != second).all()
+            and (pair_second != first).all()
+            and (pair_second != second).all()
         )
 
         # remove pair node
-        pre = solution.argsort()  # pre=[1,2,0]
-        pre_pair_first = pre.gather(1, pair_first)  # (batch_size, 1)
-        post_pair_first = solution.gather(1, pair_first)  # (batch_size, 1)
-
-        solution.scatter_(1, pre_pair_first, post_pair_first)  # remove pair first
-        solution.scatter_(
-            1, pair_first, pair_first
-        )  # let: pair first -> pair first, for next line's pre correct
+        pre_pair_first, post_pair_first = PDP._remove_node(solution, pair_first)
+        pre_pair_second, post_pair_second = PDP._remove_node(solution, pair_second)
 
-        pre = solution.argsort()
-
-        pre_pair_second = pre.gather(1, pair_first + graph_size_plus1 // 2)
-        post_pair_second = solution.gather(1, pair_first + graph_size_plus1 // 2)
+        # insert pair node
+        post_second = PDP._insert_node(solution, pair_second, second)
+        post_first = PDP._insert_node(solution, pair_first, first)
+
+        # only the visits between the old and new positions of the pair are shifted
+        if solution.visit_index is not None:
+            visit_index_old = solution.visit_index.clone()
+            PDP._remove_visit(solution.visit_index, pair_first)
+            PDP._remove_visit(solution.visit_index, pair_second)
+            PDP._insert_visit(solution.visit_index, pair_second, second)
+            PDP._insert_visit(solution.visit_index, pair_first, first)
+            if solution.top2 is not None:
+                solution.top2 = PDP._move_stack_top2(
+                    solution.top2,
+                    visit_index_old,
+                    solution.visit_index,
+                    pair_first,
+                    first,
+                )
+
+        # the neighbours met along the way, enough to get the change of the objective
+        neighbours = torch.cat(
+            (
+                pre_pair_first,
+                post_pair_first,
+                pre_pair_second,
+                post_pair_second,
+                post_second,
+                post_first,
+            ),
+            1,
+        )  # (batch_size, 6)
+
+        return solution, neighbours
 
-        solution.scatter_(1, pre_pair_second, post_pair_second)  # remove pair second
+    @staticmethod
+    def _get_edge_lengths(
+        batch_feature: torch.Tensor,  # (batch_size, graph_size+1, 2)
+        from_nodes: torch.Tensor,  # (batch_size, n_edges)
+        to_nodes: torch.Tensor,  # (batch_size, n_edges)
+        zoom: bool = False,
+        distances: Optional[torch.Tensor] = None,  # (n_tables, graph_size+1, ...)
+        distance_rows: Optional[torch.Tensor] = None,  # table of each row
+    ) -> torch.Tensor:
+        batch_size, n_edges = from_nodes.size()
+        if distances is not None:  # a table lookup, the table may be float16
+            graph_size_plus1 = distances.size(1)
+            if distance_rows is None:  # one table per row
+                distance_rows = torch.arange(batch_size, device=from_nodes.device)
+            index = (
+                distance_rows.view(-1, 1) * graph_size_plus1 + from_nodes.long()
+            ) * graph_size_plus1 + to_nodes.long()
+            length = distances.take(index).float()
+            return torch.round(length) if zoom else length
+        d1 = batch_feature.gather(
+            1, from_nodes.long().unsqueeze(-1).expand(batch_size, n_edges, 2)
+        )
+        d2 = batch_feature.gather(
+            1, to_nodes.long().unsqueeze(-1).expand(batch_size, n_edges, 2)
+        )
+        length = (d1 - d2).norm(p=2, dim=2)  # (batch_size, n_edges)
+        return torch.round(length) if zoom else length
 
-        # insert pair node
-        post_second = solution.gather(1, second)
-        solution.scatter_(
-            1, second, pair_first + graph_size_plus1 // 2
-        )  # second -> pair_second
-        solution.scatter_(1, pair_first + graph_size_plus1 // 2, post_second)
+    @staticmethod
+    def _get_distance_matrix(
+        batch_feature: torch.Tensor,  # (batch_size, graph_size+1, 2)
+    ) -> torch.Tensor:
+        # the same edge lengths as _get_edge_lengths, for all pairs at once
+        return (batch_feature.unsqueeze(2) - batch_feature.unsqueeze(1)).norm(
+            p=2, dim=3
+        )  # (batch_size, graph_size+1, graph_size+1)
 
-        post_first = solution.gather(1, first)
-        solution.scatter_(1, first, pair_first)  # first -> pair_first
-        solution.scatter_(1, pair_first, post_first)
+    @staticmethod
+    def _get_delta_costs(
+        batch_feature: torch.Tensor,  # (batch_size, graph_size+1, 2)
+        pair_first: torch.Tensor,  # (batch_size, 1)
+        first: torch.Tensor,  # (batch_size, 1)
+        second: torch.Tensor,  # (batch_size, 1)
+        neighbours: torch.Tensor,  # (batch_size, 6), from _insert_star
+        zoom: bool = False,
+        distances: Optional[torch.Tensor] = None,
+        distance_rows: Optional[torch.Tensor] = None,
+    ) -> torch.Tensor:
+        pair_second = pair_first + batch_feature.size(1) // 2
+        (
+            pre_pair_first,
+            post_pair_first,
+            pre_pair_second,
+            post_pair_second,
+            post_second,
+            post_first,
+        ) = neighbours.split(1, 1)
+
+        # removed edges come first, then added edges
+        from_nodes = torch.cat(
+            (
+                pre_pair_first,
+                pair_first,
+                pre_pair_second,
+                pair_second,
+                second,
+                first,
+                pre_pair_first,
+                pre_pair_second,
+                second,
+                pair_second,
+                first,
+                pair_first,
+            ),
+            1,
+        )
+        to_nodes = torch.cat(
+            (
+                pair_first,
+                post_pair_first,
+                pair_second,
+                post_pair_second,
+                post_second,
+                post_first,
+                post_pair_first,
+                post_pair_second,
+                pair_second,
+                post_second,
+                pair_first,
+                post_first,
+            ),
+            1,
+        )
+        length = PDP._get_edge_lengths(
+            batch_feature, from_nodes, to_nodes, zoom, distances, distance_rows
+        )
 
-        return solution
+        return length[:, 6:].sum(1) - length[:, :6].sum(1)  # (batch_size,)
 
     @staticmethod
     def make_dataset(
@@ -99,14 +432,32 @@ class PDP(ABC):
         num_samples: int = 10000,
         offset: int = 0,
         silence: bool = False,
-    ) -> 'PDPDataset':
-        return PDPDataset(filename, size, num_samples, offset, silence)
+        distance_dtype: str = 'none',
+        device: Optional[torch.device] = None,
+        generator: Optional[torch.Generator] = None,
+    ) -> Union['PDPDataset', 'PDPMemmapDataset']:
+        if filename is not None and os.path.splitext(filename)[1] == '.npy':
+            return PDPMemmapDataset(
+                filename, size, num_samples, offset, silence, distance_dtype
+            )
+        return PDPDataset(
+            filename,
+            size,
+            num_samples,
+            offset,
+            silence,
+            distance_dtype,
+            device,
+            generator,
+        )
 
     def get_costs(
         self,
         batch_feature: torch.Tensor,
         solution: torch.Tensor,
         zoom: bool = False,
+        distances: Optional[torch.Tensor] = None,
+        distance_rows: Optional[torch.Tensor] = None,
     ) -> torch.Tensor:
         batch_size, graph_size_plus1 = solution.size()
 
@@ -115,6 +466,16 @@ class PDP(ABC):
             self._check_feasibility(solution)
 
         # calculate obj value
+        if distances is not None:
+            nodes = torch.arange(graph_size_plus1, device=solution.device)
+            return PDP._get_edge_lengths(
+                batch_feature,
+                nodes.expand(batch_size, graph_size_plus1),
+                solution,
+                zoom,
+                distances,
+                distance_rows,
+            ).sum(1)
         d1 = batch_feature.gather(
             1, solution.long().unsqueeze(-1).expand(batch_size, graph_size_plus1, 2)
         )
@@ -131,35 +492,56 @@ class PDP(ABC):
         batch: Dict[
             str, torch.Tensor
         ],  # ['coordinates']: (batch_size, graph_size+1, 2)
-        solution: torch.Tensor,  # (batch_size, graph_size+1)
+        solution: SolutionState,
         action: torch.Tensor,  # (batch_size, 3)
         pre_best_obj: torch.Tensor,  # (batch_size, 2) or (batch_size,)
-        action_removal_record: List[torch.Tensor],  # len * (batch_size, graph_size/2)
+        action_removal_record: ActionRemovalRecord,
         best_sol: Optional[torch.Tensor] = None,  # (batch_size, graph_size+1)
         zoom: bool = False,
-    ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor, List[torch.Tensor]]:
-        batch_size = solution.size(0)
+        full_cost: bool = False,  # recompute the whole objective instead of delta
+    ) -> Tuple[SolutionState, torch.Tensor, torch.Tensor, ActionRemovalRecord]:
+        batch_size = solution.post.size(0)
         pre_best_obj = pre_best_obj.view(batch_size, -1)
+        distances = batch.get('distances')  # only if the dataset precomputed it
+        distance_rows = batch.get('distance_rows')  # shared by augments, if set
 
-        action_removal_record = action_removal_record.copy()
-        cur_vec = torch.zeros_like(action_removal_record.pop(0))  # new tensor
-        cur_vec[torch.arange(batch_size), action[:, 0]] = 1
-        action_removal_record.append(cur_vec)
+        action_removal_record.push(action[:, 0])
 
         selected_minus1 = action[:, 0].view(batch_size, 1)
         first = action[:, 1].view(batch_size, 1)
         second = action[:, 2].view(batch_size, 1)
 
-        next_state = PDP._insert_star(solution, selected_minus1 + 1, first, second)
+        next_state, neighbours = PDP._insert_star(
+            solution, selected_minus1 + 1, first, second
+        )
 
-        new_obj = self.get_costs(batch['coordinates'], next_state, zoom)
+        if full_cost:
+            new_obj = self.get_costs(
+                batch['coordinates'], next_state.post, zoom, distances, distance_rows
+            )
+        else:
+            if self.check_feasible:
+                self._check_feasibility(next_state.post)
+            # only the edges around the moved pair change, pre_best_obj[:, 0] is current
+            new_obj = pre_best_obj[:, 0] + PDP._get_delta_costs(
+                batch['coordinates'],
+                selected_minus1 + 1,
+                first,
+                second,
+                neighbours,
+                zoom,
+                distances,
+                distance_rows,
+            )
 
         now_best_obj, from_which = torch.min(
             torch.cat((new_obj[:, None], pre_best_obj[:, -1, None]), -1), -1
         )
 
         if best_sol is not None:
-            choose_from = torch.cat((next_state.unsqueeze(1), best_sol.unsqueeze(1)), 1)
+            choose_from = torch.cat(
+                (next_state.post.unsqueeze(1), best_sol.unsqueeze(1)), 1
+            )
             best_sol[torch.arange(batch_size), :] = choose_from[
                 torch.arange(batch_size), from_which, :
             ]
@@ -174,19 +556,49 @@ class PDP(ABC):
         )
 
     @staticmethod
-    def direct_solution(solution: torch.Tensor) -> torch.Tensor:
+    def get_visit_index(solution: torch.Tensor) -> torch.Tensor:
+        # visit order of every node (depot is 0), by pointer jumping instead of a walk
         batch_size, seq_length = solution.size()
-        arange = torch.arange(batch_size)
-        visit_index = torch.zeros((batch_size, seq_length), device=solution.device)
-        pre = torch.zeros((batch_size), device=solution.device).long()
 
-        for i in range(seq_length):
-            current_nodes = solution[arange, pre]  # (batch_size,)
-            visit_index[arange, current_nodes] = i + 1
-            pre = current_nodes
+        # steps from every node to the depot, doubled with every jump
+        jump = solution.clone()
+        jump[:, 0] = 0
+        steps = torch.ones_like(solution)
+        steps[:, 0] = 0
+
+        for _ in range(math.ceil(math.log2(seq_length))):
+            steps = steps + steps.gather(1, jump)
+            jump = jump.gather(1, jump)
 
-        visit_index = (visit_index % seq_length).long()
-        return visit_index.argsort()
+        return (seq_length - steps) % seq_length  # (batch_size, graph_size+1)
+
+    @staticmethod
+    def get_stack_top2(visit_index: torch.Tensor) -> torch.Tensor:
+        # stack tops after visiting every node,
+        # as (current_stack_top, last_stack_top_or_0)
+        batch_size, seq_length = visit_index.size()
+        half_size = seq_length // 2
+
+        visit_time = visit_index.clone()
+        visit_time[:, 0] = seq_length  # depot is visited at last
+        pickup_time = visit_time[:, None, 1 : half_size + 1]
+        delivery_time = visit_time[:, None, half_size + 1 :]
+        now = visit_time[:, :, None]
+
+        stacks = torch.where(
+            (pickup_time <= now) & (delivery_time > now),
+            pickup_time.float(),
+            torch.tensor(-0.01, device=visit_index.device),
+        )  # (batch_size, graph_size+1, graph_size/2)
+        stacks = torch.cat(
+            (stacks.new_zeros(batch_size, seq_length, 1), stacks), 2
+        )  # fix bug: topk is not stable sorting
+
+        return stacks.topk(2)[1]  # (batch_size, graph_size+1, 2)
+
+    @staticmethod
+    def direct_solution(solution: torch.Tensor) -> torch.Tensor:
+        return PDP.get_visit_index(solution).argsort()
 
 
 class PDPDataset(Dataset):
@@ -197,47 +609,60 @@ class PDPDataset(Dataset):
         num_samples: int,
         offset: int,
         silence: bool,
+        distance_dtype: str = 'none',
+        device: Optional[torch.device] = None,  # only for random instances
+        generator: Optional[torch.Generator] = None,  # on device, if given
     ):
         super().__init__()
 
-        self.data: List[Dict[str, torch.Tensor]] = []
         self.size = size
 
+        # stored as columns, so that a batch is one slice of them
         if filename is not None:
             assert os.path.splitext(filename)[1] == '.pkl', 'file name error'
 
             with open(filename, 'rb') as f:
                 data = pickle.load(f)
-            self.data = [
-                PDPDataset._make_instance(args)
-                for args in data[offset : offset + num_samples]
-            ]
+            self.coordinates = torch.stack(
+                [
+                    torch.cat((instance['depot'].reshape(1, 2), instance['loc']), 0)
+                    for instance in map(
+                        PDPDataset._make_instance, data[offset : offset + num_samples]
+                    )
+                ]
+            )  # (N, graph_size+1, 2)
 
         else:
-            self.data = [
-                {
-                    'loc': torch.FloatTensor(self.size, 2).uniform_(0, 1),
-                    'depot': torch.FloatTensor(2).uniform_(0, 1),
-                }
-                for _ in range(num_samples)
-            ]
-
-        self.N = len(self.data)
-
-        for i, instance in enumerate(self.data):
-            self.data[i]['coordinates'] = torch.cat(
-                (instance['depot'].reshape(1, 2), instance['loc']), dim=0
+            # all instances at once, the depot is node 0
+            self.coordinates = torch.rand(
+                (num_samples, self.size + 1, 2), generator=generator, device=device
             )
-            del self.data[i]['depot']
-            del self.data[i]['loc']
+
+        self.N = len(self.coordinates)
+        self.distances: Optional[torch.Tensor] = None
+        if distance_dtype != 'none':  # returned along with the coordinates
+            self.distances = torch.cat(
+                [
+                    PDP._get_distance_matrix(coordinates).to(
+                        getattr(torch, distance_dtype)
+                    )
+                    for coordinates in self.coordinates.split(1024)
+                ]
+            )  # (N, graph_size+1, graph_size+1)
         if not silence:
             print(f'{self.N} instances initialized.')
 
     def __len__(self) -> int:
         return self.N
 
-    def __getitem__(self, idx: int) -> Dict[str, torch.Tensor]:
-        return self.data[idx]
+    def __getitem__(
+        self, idx: Union[int, slice, List[int]]
+    ) -> Dict[str, torch.Tensor]:
+        # an int gives an instance, a slice or a list of indices gives a batch
+        batch = {'coordinates': self.coordinates[idx]}
+        if self.distances is not None:
+            batch['distances'] = self.distances[idx]
+        return batch
 
     @staticmethod
     def _make_instance(args: Iterable) -> Dict[str, torch.Tensor]:
@@ -260,3 +685,97 @@ class PDPDataset(Dataset):
         dists = d1 + d2 + d3
         dists[dists < 0] = 0
         return torch.sqrt(dists)
+
+
+class PDPMemmapDataset(Dataset):
+    def __init__(
+        self,
+        filename: str,
+        size: int,
+        num_samples: int,
+        offset: int,
+        silence: bool,
+        distance_dtype: str = 'none',
+    ):
+        super().__init__()
+
+        assert os.path.splitext(filename)[1] == '.npy', 'file name error'
+
+        # one (N, graph_size+1, 2) float32 array, only the header is read here,
+        # copy-on-write so that slices can be wrapped by torch without a copy
+        coordinates = np.load(filename, mmap_mode='c')
+        assert coordinates.shape[1:] == (size + 1, 2), 'graph size error'
+        self.coordinates = coordinates[offset : offset + num_samples]
+        self.size = size
+        self.distance_dtype = distance_dtype
+
+        self.N = len(self.coordinates)
+        if not silence:
+            print(f'{self.N} instances mapped.')
+
+    def __len__(self) -> int:
+        return self.N
+
+    def __getitem__(
+        self, idx: Union[int, slice, List[int]]
+    ) -> Dict[str, torch.Tensor]:
+        # an int gives an instance, a slice or a list of indices gives a batch
+        # an int or a slice gives a view of the file, a list a copy
+        coordinates = torch.from_numpy(self.coordinates[idx])
+        batch = {'coordinates': coordinates}
+        if self.distance_dtype != 'none':  # computed per batch, the file has none
+            distances = PDP._get_distance_matrix(
+                coordinates.view(-1, self.size + 1, 2)
+            ).to(getattr(torch, self.distance_dtype))
+            batch['distances'] = distances[0] if isinstance(idx, int) else distances
+        return batch
+
+    @staticmethod
+    def from_pkl(filename: str, out_filename: Optional[str] = None) -> str:
+        # write the instances of a pdp_*.pkl file as one contiguous .npy array,
+        # scaled by the grid size as PDPDataset does
+        assert os.path.splitext(filename)[1] == '.pkl', 'file name error'
+        if out_filename is None:
+            out_filename = os.path.splitext(filename)[0] + '.npy'
+
+        with open(filename, 'rb') as f:
+            data = pickle.load(f)
+        n_nodes = len(data[0][1]) + 1
+        out = np.lib.format.open_memmap(
+            out_filename, mode='w+', dtype=np.float32, shape=(len(data), n_nodes, 2)
+        )
+        for i, args in enumerate(data):
+            instance = PDPDataset._make_instance(args)
+            out[i, 0] = instance['depot'].numpy()
+            out[i, 1:] = instance['loc'].numpy()
+        out.flush()
+        return out_filename
+
+
+class SliceSampler(Sampler):
+    def __init__(
+        self,
+        n_samples: int,
+        batch_size: int,
+        num_replicas: int = 1,
+        rank: int = 0,
+    ) -> None:
+        # yields whole batches as slices, for a DataLoader with batch_size=None
+        # each replica gets a contiguous share, padded from the start of the dataset
+        # as DistributedSampler pads, so that the shares concat in dataset order
+        self.n_samples = n_samples
+        self.batch_size = batch_size
+        self.per_replica = math.ceil(n_samples / num_replicas)
+        self.start = rank * self.per_replica
+
+    def __iter__(self) -> Iterator[Union[slice, List[int]]]:
+        end_replica = self.start + self.per_replica
+        for start in range(self.start, end_replica, self.batch_size):
+            end = min(start + self.batch_size, end_replica)
+            if end <= self.n_samples:
+                yield slice(start, end)
+            else:
+                yield [i % self.n_samples for i in range(start, end)]
+
+    def __len__(self) -> int:
+        return math.ceil(self.per_replica / self.batch_size)
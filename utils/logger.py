@@ -5,6 +5,16 @@ from tensorboard_logger import Logger as TbLogger
 from agent.agent import Agent
 
 
+def _step_reward_mean_std(
+    reward: torch.Tensor, steps_used: torch.Tensor
+) -> Tuple[float, float]:
+    # reward: (dataset_size, 2), sum and sum of squares over the steps used
+    n = max(int(steps_used.sum()), 1)
+    mean = reward[:, 0].sum().item() / n
+    var = (reward[:, 1].sum().item() - n * mean * mean) / max(n - 1, 1)
+    return mean, math.sqrt(max(var, 0.0))
+
+
 def log_to_screen(
     time_used: torch.Tensor,
     init_value: torch.Tensor,
@@ -15,19 +25,23 @@ def log_to_screen(
     batch_size: int,
     dataset_size: int,
     T: int,
+    history_steps: List[int],
+    steps_used: torch.Tensor,
+    time_fractions: Optional[List[float]] = None,
 ) -> None:
     # reward
+    step_reward_mean, step_reward_std = _step_reward_mean_std(reward, steps_used)
     print('\n', '-' * 60)
     print(
         'Avg total reward:'.center(35),
         '{:<10f} +- {:<10f}'.format(
-            reward.sum(1).mean(), torch.std(reward.sum(1)) / math.sqrt(batch_size)
+            reward[:, 0].mean(), torch.std(reward[:, 0]) / math.sqrt(batch_size)
         ),
     )
     print(
         'Avg step reward:'.center(35),
         '{:<10f} +- {:<10f}'.format(
-            reward.mean(), torch.std(reward) / math.sqrt(batch_size)
+            step_reward_mean, step_reward_std / math.sqrt(batch_size)
         ),
     )
 
@@ -40,24 +54,46 @@ def log_to_screen(
         ),
     )
     for per in range(500, T, 500):
-        cost_ = costs_history[:, per]
+        if per not in history_steps:
+            continue
+        cost_ = costs_history[:, history_steps.index(per)]
         print(
             f'Avg cost after T={per} steps:'.center(35),
             '{:<10f} +- {:<10f}'.format(
                 cost_.mean(), torch.std(cost_) / math.sqrt(batch_size)
             ),
         )
+    if time_fractions is not None:
+        for i, fraction in enumerate(time_fractions[1:], 1):
+            cost_ = costs_history[:, i]
+            print(
+                f'Avg cost at {fraction:.0%} of time:'.center(35),
+                '{:<10f} +- {:<10f}'.format(
+                    cost_.mean(), torch.std(cost_) / math.sqrt(batch_size)
+                ),
+            )
     # best cost
     print('-' * 60)
 
     for per in range(500, T, 500):
-        cost_ = search_history[:, per]
+        if per not in history_steps:
+            continue
+        cost_ = search_history[:, history_steps.index(per)]
         print(
             f'Avg best cost after T={per} steps:'.center(35),
             '{:<10f} +- {:<10f}'.format(
                 cost_.mean(), torch.std(cost_) / math.sqrt(batch_size)
             ),
         )
+    if time_fractions is not None:
+        for i, fraction in enumerate(time_fractions[1:], 1):
+            cost_ = search_history[:, i]
+            print(
+                f'Avg best cost at {fraction:.0%} of time:'.center(35),
+                '{:<10f} +- {:<10f}'.format(
+                    cost_.mean(), torch.std(cost_) / math.sqrt(batch_size)
+                ),
+            )
     print(
         f'Avg final best cost:'.center(35),
         '{:<10f} +- {:<10f}'.format(
@@ -66,9 +102,24 @@ def log_to_screen(
     )
     print('Final best cost:'.center(35), '{:f}'.format(best_value.min()))
 
+    # steps
+    print('-' * 60)
+    print(
+        'Avg used steps:'.center(35),
+        '{:<10f} +- {:<10f}'.format(
+            steps_used.float().mean(),
+            torch.std(steps_used.float()) / math.sqrt(batch_size),
+        ),
+    )
+    print('Max used steps:'.center(35), '{:d}'.format(int(steps_used.max())))
+
     # time
     print('-' * 60)
     print('Avg used time:'.center(35), '{:f}s'.format(time_used.mean() / dataset_size))
+    print(
+        'Instances per second:'.center(35),
+        '{:f}'.format(dataset_size / time_used.mean()),
+    )
     print('-' * 60, '\n')
 
 
@@ -84,20 +135,38 @@ def log_to_tb_val(
     val_size: int,
     dataset_size: int,
     T: int,
+    history_steps: List[int],
+    steps_used: torch.Tensor,
     epoch: Optional[int],
+    time_fractions: Optional[List[float]] = None,
 ) -> None:
 
     tb_logger.log_value('validation/avg_time', time_used.mean() / dataset_size, epoch)
-    tb_logger.log_value('validation/avg_total_reward', reward.sum(1).mean(), epoch)
-    tb_logger.log_value('validation/avg_step_reward', reward.mean(), epoch)
+    tb_logger.log_value('validation/avg_total_reward', reward[:, 0].mean(), epoch)
+    tb_logger.log_value(
+        'validation/avg_step_reward',
+        _step_reward_mean_std(reward, steps_used)[0],
+        epoch,
+    )
+    tb_logger.log_value(
+        'validation/instances_per_second', dataset_size / time_used.mean(), epoch
+    )
 
     tb_logger.log_value(f'validation/avg_init_cost', init_value.mean(), epoch)
     tb_logger.log_value(f'validation/avg_best_cost', best_value.mean(), epoch)
+    tb_logger.log_value('validation/avg_used_steps', steps_used.float().mean(), epoch)
 
     for per in range(20, 100, 20):
-        cost_ = costs_history[:, round(T * per / 100)]
+        if round(T * per / 100) not in history_steps:
+            continue
+        cost_ = costs_history[:, history_steps.index(round(T * per / 100))]
         tb_logger.log_value(f'validation/avg_.{per}_cost', cost_.mean(), epoch)
 
+    if time_fractions is not None:
+        for per in range(20, 100, 20):
+            cost_ = costs_history[:, round((len(time_fractions) - 1) * per / 100)]
+            tb_logger.log_value(f'validation/avg_.{per}_time_cost', cost_.mean(), epoch)
+
 
 def log_to_tb_train(
     tb_logger: TbLogger,
@@ -108,7 +177,7 @@ def log_to_tb_train(
     bl_val_detached: torch.Tensor,
     total_cost: torch.Tensor,
     grad_norms_tuple: Tuple[List[torch.Tensor], List[torch.Tensor]],
-    reward: List[torch.Tensor],
+    reward: torch.Tensor,  # (n_step, batch_size)
     entropy: torch.Tensor,
     approx_kl_divergence: torch.Tensor,
     reinforce_loss: torch.Tensor,
@@ -150,8 +219,8 @@ def log_to_tb_train(
     if trust_degree is not None:
         tb_logger.log_value('train/trust_degree', trust_degree.item(), mini_step)
 
-    avg_reward = torch.stack(reward, 0).sum(0).mean().item()
-    max_reward = torch.stack(reward, 0).max(0)[0].mean().item()
+    avg_reward = reward.sum(0).mean().item()
+    max_reward = reward.max(0)[0].mean().item()
     tb_logger.log_value('train/avg_reward', avg_reward, mini_step)
     tb_logger.log_value('train/init_cost', initial_cost.mean(), mini_step)
     tb_logger.log_value('train/max_reward', max_reward, mini_step)
@@ -18,6 +18,23 @@ def rotate_tensor(x: torch.Tensor, d: float) -> torch.Tensor:
     return torch.matmul(x - 0.5, rot_mat) + 0.5
 
 
+def get_dihedral_mats() -> torch.Tensor:
+    # the 8 symmetries of the unit square, as x -> (x - 0.5) @ mat + 0.5
+    return torch.tensor(
+        [
+            [[1, 0], [0, 1]],
+            [[0, -1], [1, 0]],  # rotations by 90, 180 and 270 degrees
+            [[-1, 0], [0, -1]],
+            [[0, 1], [-1, 0]],
+            [[0, 1], [1, 0]],  # x <-> y, and it after the rotations
+            [[-1, 0], [0, 1]],
+            [[0, -1], [-1, 0]],
+            [[1, 0], [0, -1]],
+        ],
+        dtype=torch.float,
+    )  # (8, 2, 2)
+
+
 def torch_load_cpu(load_path: str) -> Dict[str, Any]:
     return torch.load(
         load_path, map_location=lambda storage, loc: storage